@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+from astropy.io import fits
+
+import fitsconcat
+
+
+def make_channel_images(outdir, freqs, shape, nstokes=1, seed=42):
+    """
+    Write one synthetic single-channel image per frequency, with nstokes
+    planes of the given (ny, nx) shape. Also used by tests/test_fitsconcat.
+    """
+
+    header = fits.Header()
+    header['CTYPE3'] = 'FREQ'
+    header['CRPIX3'] = 1
+    header['CDELT3'] = 1e6
+
+    rng = np.random.default_rng(seed)
+    imlist = []
+    for freq in freqs:
+        header['CRVAL3'] = freq
+        data = rng.standard_normal((nstokes, 1) + tuple(shape), dtype=np.float32)
+        imname = os.path.join(outdir, f"chan_{freq / 1e6:.0f}.fits")
+        fits.PrimaryHDU(data=data, header=header).writeto(imname, overwrite=True)
+        imlist.append(imname)
+
+    return imlist
+
+
+def drop_caches():
+    # Only possible as root on Linux, as in shell/bench_io.sh
+    if os.uname().sysname == 'Linux' and os.geteuid() == 0:
+        subprocess.run(['sync'])
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+
+
+def run_concat(imlist, outname, nstokes, writer, workers):
+    drop_caches()
+    for fname in (outname, fitsconcat.manifest_name(outname)):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+    t0 = time.time()
+    manifest = fitsconcat.prepare_cube(imlist, nstokes=nstokes, outname=outname)
+    fitsconcat.fill_cube_with_images(imlist, nstokes=nstokes, outname=outname,
+                                     workers=workers, manifest=manifest, writer=writer)
+    os.sync()
+    return time.time() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fitsconcat writers (astropy memmap vs raw positional writes). "
+                    "Pick --nchan and --npix so the cube is larger than RAM to see the "
+                    "out-of-core behaviour.")
+    parser.add_argument("--nchan", type=int, default=64, help="Number of channels (default: 64)")
+    parser.add_argument("--npix", type=int, default=4096, help="Image side in pixels (default: 4096)")
+    parser.add_argument("--nstokes", type=int, default=1, help="Number of Stokes planes (default: 1)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="Worker counts to try with the raw writer (default: 1)")
+    parser.add_argument("--dir", default=None,
+                        help="Directory for the inputs and cube (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark files")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_fitsconcat_', dir=args.dir)
+    cube_size = args.nchan * args.nstokes * args.npix**2 * 4
+    ram_size = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    print(f"Cube size {cube_size / 1024**3:.2f} GB, RAM {ram_size / 1024**3:.2f} GB")
+    if cube_size < ram_size:
+        print("WARNING : the cube fits in RAM, the page cache will flatter both writers")
+
+    try:
+        print(f"Writing {args.nchan} input images to {workdir}")
+        freqs = [1e9 + ii * 1e6 for ii in range(args.nchan)]
+        imlist = make_channel_images(workdir, freqs, (args.npix, args.npix), args.nstokes)
+        outname = os.path.join(workdir, 'concat.fits')
+
+        runs = [('memmap', 1)] + [('raw', ww) for ww in args.workers]
+        results = []
+        for writer, workers in runs:
+            elapsed = run_concat(imlist, outname, args.nstokes, writer, workers)
+            results.append((writer, workers, elapsed))
+
+        print(f"{'Writer':<8} {'Workers':>8} {'Time (s)':>10} {'MB/s':>10}")
+        for writer, workers, elapsed in results:
+            print(f"{writer:<8} {workers:>8} {elapsed:>10.2f} {cube_size / 1024**2 / elapsed:>10.1f}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
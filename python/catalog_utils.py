@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+
+import os
+import numpy as np
+
+# Parsed catalogs and other derived tables are cached here. Each cache stores
+# a version number, which its script bumps whenever the cached layout or the
+# parsing changes, so that old caches are rebuilt rather than misread.
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "astroscripts")
+
+
+def unit_vectors(ra_deg, dec_deg):
+    """
+    Cartesian unit vectors for arrays of RA/DEC in degrees.
+    """
+
+    ra = np.radians(ra_deg)
+    dec = np.radians(dec_deg)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def read_fields(fname):
+    """
+    Fields of every line of a text file of positions, whitespace or comma
+    separated. '#' starts a comment, and empty lines are skipped.
+    """
+
+    rows = []
+    with open(fname) as fptr:
+        for line in fptr:
+            fields = line.split('#')[0].replace(',', ' ').split()
+            if fields:
+                rows.append(fields)
+    return rows
+
+
+def parse_positions(ras, decs):
+    """
+    Turn RA/DEC strings, each in decimal degrees or sexagesimal (HMS/DMS),
+    into arrays in degrees.
+    """
+
+    ra = np.empty(len(ras))
+    dec = np.empty(len(ras))
+    sexagesimal = []
+    for ii, (rr, dd) in enumerate(zip(ras, decs)):
+        try:
+            ra[ii], dec[ii] = float(rr), float(dd)
+        except ValueError:
+            sexagesimal.append(ii)
+
+    # All the sexagesimal positions are parsed in one go
+    if sexagesimal:
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+
+        coords = SkyCoord([ras[ii] for ii in sexagesimal], [decs[ii] for ii in sexagesimal],
+                          unit=(u.hourangle, u.deg))
+        ra[sexagesimal] = coords.ra.deg
+        dec[sexagesimal] = coords.dec.deg
+
+    return ra, dec
@@ -0,0 +1,259 @@
+#! /usr/bin/env python
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from multiprocessing.pool import Pool
+
+from catalog_utils import unit_vectors
+
+# Spill file record : row number in the input catalog and its position
+SPILL_DTYPE = np.dtype([('row', 'i8'), ('ra', 'f8'), ('dec', 'f8')])
+# Rows of the first catalog matched at once, and the most rows of the second
+# catalog they are compared against in one dot product
+MATCH_BLOCK = 1024
+WINDOW_BLOCK = 8192
+
+
+def read_chunks(fname, ra_col, dec_col, chunk):
+    """
+    Yield (ra, dec) arrays in degrees of at most chunk rows from a CSV or
+    FITS table, without loading the whole table.
+    """
+
+    if fname.lower().endswith(('.fits', '.fit', '.fits.gz')):
+        from astropy.io import fits
+
+        with fits.open(fname, memmap=True) as hdul:
+            data = hdul[1].data
+            for start in range(0, len(data), chunk):
+                rows = data[start:start + chunk]
+                yield np.asarray(rows[ra_col], dtype=float), np.asarray(rows[dec_col], dtype=float)
+    else:
+        import pandas as pd
+
+        for df in pd.read_csv(fname, usecols=[ra_col, dec_col], chunksize=chunk):
+            yield df[ra_col].to_numpy(dtype=float), df[dec_col].to_numpy(dtype=float)
+
+
+def strip_index(dec, strip_height):
+    return np.clip(((np.asarray(dec) + 90) // strip_height).astype(int), 0, nstrips(strip_height) - 1)
+
+
+def nstrips(strip_height):
+    return int(np.ceil(180 / strip_height))
+
+
+def spill_name(workdir, cat, strip):
+    return os.path.join(workdir, f"cat{cat}_strip{strip:05d}.bin")
+
+
+def partition_catalog(fname, ra_col, dec_col, cat, workdir, strip_height, chunk):
+    """
+    Stream a catalog into per declination strip spill files, one chunk at a
+    time. Returns the number of rows.
+    """
+
+    nrows = 0
+    for ra, dec in read_chunks(fname, ra_col, dec_col, chunk):
+        records = np.empty(len(ra), dtype=SPILL_DTYPE)
+        records['row'] = np.arange(nrows, nrows + len(ra))
+        records['ra'] = np.mod(ra, 360.)
+        records['dec'] = dec
+        strips = strip_index(dec, strip_height)
+        order = np.argsort(strips, kind='stable')
+        bounds = np.searchsorted(strips[order], np.arange(nstrips(strip_height) + 1))
+        for ss in np.flatnonzero(np.diff(bounds)):
+            with open(spill_name(workdir, cat, ss), 'ab') as fptr:
+                records[order[bounds[ss]:bounds[ss + 1]]].tofile(fptr)
+        nrows += len(ra)
+
+    return nrows
+
+
+def load_spill(workdir, cat, strip):
+    fname = spill_name(workdir, cat, strip)
+    if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+        return np.empty(0, dtype=SPILL_DTYPE)
+    return np.memmap(fname, dtype=SPILL_DTYPE, mode='r')
+
+
+def sort_spill(workdir, cat, strip, chunk):
+    """
+    Sort a spill file by RA in place, in runs of at most chunk rows, and
+    write the RA of its rows to a file of their own, which can be searched
+    through a memmap without being read in full.
+    """
+
+    fname = spill_name(workdir, cat, strip)
+    spill = np.memmap(fname, dtype=SPILL_DTYPE, mode='r+')
+    spill_ra = np.memmap(fname + '.ra', dtype='f8', mode='w+', shape=len(spill))
+    for start in range(0, len(spill), chunk):
+        run = np.array(spill[start:start + chunk])
+        run = run[np.argsort(run['ra'], kind='stable')]
+        spill[start:start + chunk] = run
+        spill_ra[start:start + chunk] = run['ra']
+    spill.flush()
+    spill_ra.flush()
+
+
+def load_runs(workdir, cat, strip, chunk):
+    """
+    The RA sorted runs of a spill file written by sort_spill, as memmapped
+    (records, ra) pairs.
+    """
+
+    spill = load_spill(workdir, cat, strip)
+    if len(spill) == 0:
+        return []
+    spill_ra = np.memmap(spill_name(workdir, cat, strip) + '.ra', dtype='f8', mode='r')
+    return [(spill[start:start + chunk], spill_ra[start:start + chunk]) for start in range(0, len(spill), chunk)]
+
+
+def ra_window(sorted_ra, ra_lo, ra_hi, halfwidth):
+    """
+    Index ranges of sorted_ra (in [0, 360)) within halfwidth of [ra_lo, ra_hi],
+    split in two where the window wraps around RA = 0/360.
+    """
+
+    lo, hi = ra_lo - halfwidth, ra_hi + halfwidth
+    if hi - lo >= 360:
+        return [(0, len(sorted_ra))]
+
+    ranges = []
+    for start, stop in [(lo, hi), (lo + 360, hi + 360), (lo - 360, hi - 360)]:
+        if stop >= 0 and start < 360:
+            ranges.append((np.searchsorted(sorted_ra, start, 'left'), np.searchsorted(sorted_ra, stop, 'right')))
+    return ranges
+
+
+def _match_strip(args):
+    """
+    Worker : match one declination strip of the first catalog against the
+    same and neighbouring strips of the second one, and write the pairs to
+    a part file. Returns the part file name and the number of pairs.
+
+    The second catalog is only read through the RA window of each block of
+    the first, from its sorted runs (see sort_spill), so memory follows the
+    chunk size and not the size of the strips.
+    """
+
+    workdir, strip, radius, strip_height, chunk = args
+    partname = os.path.join(workdir, f"pairs_{strip:05d}.csv")
+
+    left = load_spill(workdir, 1, strip)
+    runs = [run for ss in (strip - 1, strip, strip + 1) if 0 <= ss < nstrips(strip_height)
+            for run in load_runs(workdir, 2, ss, chunk)]
+    npairs = 0
+    with open(partname, 'w') as out:
+        if len(left) == 0 or len(runs) == 0:
+            return partname, 0
+
+        # RA half-width of the search window, at the edge of the strip nearest the pole
+        decmax = min(max(abs(-90 + strip * strip_height), abs(-90 + (strip + 1) * strip_height)), 90)
+        ratio = np.sin(np.radians(radius)) / max(np.cos(np.radians(decmax)), 1e-12)
+        halfwidth = 360. if ratio >= 1 else np.degrees(np.arcsin(ratio))
+        cosrad = np.cos(np.radians(radius))
+
+        # The left strip is read in chunks, so memory follows the chunk size
+        for start in range(0, len(left), chunk):
+            block = np.array(left[start:start + chunk])
+            block = block[np.argsort(block['ra'])]
+            block_vec = unit_vectors(block['ra'], block['dec'])
+            for bb in range(0, len(block), MATCH_BLOCK):
+                avec = block_vec[bb:bb + MATCH_BLOCK]
+                arows = block['row'][bb:bb + MATCH_BLOCK]
+                for right, right_ra in runs:
+                    ranges = ra_window(right_ra, block['ra'][bb], block['ra'][bb:bb + MATCH_BLOCK][-1], halfwidth)
+                    for lo, hi in ranges:
+                        for ww in range(lo, hi, WINDOW_BLOCK):
+                            window = np.array(right[ww:min(ww + WINDOW_BLOCK, hi)])
+                            cossep = avec @ unit_vectors(window['ra'], window['dec']).T
+                            ia, ib = np.nonzero(cossep >= cosrad)
+                            if len(ia) == 0:
+                                continue
+                            sep = np.degrees(np.arccos(np.clip(cossep[ia, ib], -1, 1))) * 3600
+                            pairs = np.column_stack([arows[ia], window['row'][ib], sep])
+                            np.savetxt(out, pairs, fmt=['%d', '%d', '%.4f'], delimiter=',')
+                            npairs += len(ia)
+
+    return partname, npairs
+
+
+def crossmatch(cat1, cat2, output, radius, ra_cols=('ra', 'ra'), dec_cols=('dec', 'dec'),
+               workers=1, chunk=1000000, strip_height=1.0, tmpdir=None):
+    """
+    Cross-match two catalogs of any size within radius (arcsec).
+
+    Both catalogs are streamed in chunks into declination strip spill files
+    on disk, and the cat2 strips are sorted by RA in runs of chunk rows.
+    Each strip of cat1 is then matched against the same and the adjacent
+    strips of cat2 by a pool of workers, with unit-vector dot products over
+    the RA windows of the runs, so memory is bounded by chunk and not by
+    the size of the strips. The pairs (row numbers in cat1 and
+    cat2, separation in arcsec) are written to output as CSV, in strip
+    order, without being held in memory.
+    """
+
+    radius_deg = radius / 3600.
+    # Neighbouring strips must cover the radius
+    strip_height = max(strip_height, radius_deg)
+
+    workdir = tempfile.mkdtemp(prefix='crossmatch_', dir=tmpdir)
+    try:
+        t0 = time.time()
+        nrows1 = partition_catalog(cat1, ra_cols[0], dec_cols[0], 1, workdir, strip_height, chunk)
+        nrows2 = partition_catalog(cat2, ra_cols[1], dec_cols[1], 2, workdir, strip_height, chunk)
+        for ss in range(nstrips(strip_height)):
+            if os.path.exists(spill_name(workdir, 2, ss)):
+                sort_spill(workdir, 2, ss, chunk)
+        print(f"Partitioned {nrows1} x {nrows2} rows into {nstrips(strip_height)} strips in {time.time() - t0:.1f}s")
+
+        strips = [ss for ss in range(nstrips(strip_height)) if os.path.exists(spill_name(workdir, 1, ss))]
+        tasks = [(workdir, ss, radius_deg, strip_height, chunk) for ss in strips]
+
+        total = 0
+        with open(output, 'w') as out, Pool(workers) as pool:
+            out.write("row1,row2,sep_arcsec\n")
+            # imap keeps the strip order, so the output is the same for any number of workers
+            for partname, npairs in pool.imap(_match_strip, tasks):
+                with open(partname) as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(partname)
+                total += npairs
+
+        print(f"Wrote {total} pairs to {output} in {time.time() - t0:.1f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Cross-match two catalogs (CSV or FITS tables) within a radius, streaming both "
+                    "from disk so that they can be larger than memory. Writes the matched pairs "
+                    "as CSV rows of (row1, row2, sep_arcsec), with 0-based row numbers.")
+    parser.add_argument("cat1", help="First catalog")
+    parser.add_argument("cat2", help="Second catalog")
+    parser.add_argument("radius", type=float, help="Match radius in arcsec")
+    parser.add_argument("-o", "--output", default="crossmatch.csv",
+                        help="Output CSV of pairs (default: crossmatch.csv)")
+    parser.add_argument("--ra-cols", nargs=2, default=["ra", "ra"], metavar=("RA1", "RA2"),
+                        help="RA column (degrees) of each catalog (default: ra ra)")
+    parser.add_argument("--dec-cols", nargs=2, default=["dec", "dec"], metavar=("DEC1", "DEC2"),
+                        help="DEC column (degrees) of each catalog (default: dec dec)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes matching strips (default: 1)")
+    parser.add_argument("--chunk", type=int, default=1000000,
+                        help="Rows read and matched at a time, which bounds the memory use (default: 1000000)")
+    parser.add_argument("--strip-height", type=float, default=1.0,
+                        help="Height of the declination strips in degrees (default: 1.0)")
+    parser.add_argument("--tmpdir", default=None,
+                        help="Directory for the strip spill files (default: system temporary directory)")
+    args = parser.parse_args()
+
+    crossmatch(args.cat1, args.cat2, args.output, args.radius, args.ra_cols, args.dec_cols,
+               args.workers, args.chunk, args.strip_height, args.tmpdir)
@@ -1,111 +1,1138 @@
 #! /usr/bin/env python
 
 import argparse
+import io
+import json
 import os
 import re
+import sys
 import time
+import zlib
 import numpy as np
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from multiprocessing.pool import Pool
 from astropy.io import fits
 
+BLOCK_SIZE = 2880
+# Seconds between saves of the channel manifest while filling
+MANIFEST_INTERVAL = 30
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', -32: '>f4', -64: '>f8'}
+# Stored values reserved for BLANK (NaN) in scaled integer cubes, and the
+# range left for data
+INT_BLANK = {16: -32768, 8: 255}
+INT_RANGE = {16: (-32767, 32767), 8: (0, 254)}
+# Keywords written into the header of an existing cube, by fill_cube_with_images
+# and write_checksums. make_empty_image reserves a blank card for each of them
+# that the new header lacks
+LATE_KEYS = ('NAXIS3', 'CRPIX3', 'CRVAL3', 'CDELT3', 'DATASUM', 'CHECKSUM')
+
+
 def natural_sort(l):
     convert = lambda text: int(text) if text.isdigit() else text.lower()
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(l, key=alphanum_key)
 
 
-def make_empty_image(imlist, nstokes=4, outname='concat.fits'):
+def make_empty_image(imlist, nstokes=4, outname='concat.fits', ref_header=None,
+                     stokes=None, region=None, bitpix=-32, scaling=None):
     """
     Generate an empty dummy FITS data cube. The FITS cube can exceed available
     RAM.
 
-    The 2D image dimensions are derived from the first cube in the list.
+    The 2D image dimensions are derived from the first cube in the list, or
+    from ref_header if it is given.
     The number of channels in the output cube is assumed to be the length
     of the input list of images.
 
+    If a region (y0, y1, x0, x1) is given the cube is sized to that cutout,
+    and if a list of stokes plane indices is given only those are kept. The
+    WCS reference pixels are shifted to match, see parse_region and
+    parse_stokes.
+
+    bitpix=16 or 8 makes a scaled integer cube, with scaling=(bscale, bzero)
+    as chosen by integer_scaling.
     """
 
-    with fits.open(imlist[0], memmap=True) as hdu:
-        ref_header = hdu[0].header.copy()
-        xdim, ydim = np.squeeze(hdu[0].data).shape[-2:]
+    if ref_header is None:
+        ref_header = read_header(imlist[0])
+    xdim, ydim = int(ref_header['NAXIS1']), int(ref_header['NAXIS2'])
+    if region is not None:
+        y0, y1, x0, x1 = region
+        xdim, ydim = x1 - x0, y1 - y0
 
     print("X-dimension: ", xdim)
     print("Y-dimension: ", ydim)
 
     zdim = int(len(imlist))
-    wdim = nstokes
+    wdim = nstokes if stokes is None else len(stokes)
 
     dims = tuple([xdim, ydim, zdim, wdim])
 
     # create header from first input image to preserve WCS keywords
-    dummy_data = np.zeros(tuple(1 for d in dims), dtype=np.float32)
+    dtype = np.dtype(BITPIX_DTYPES[bitpix])
+    dummy_data = np.zeros(tuple(1 for d in dims), dtype=dtype)
     hdu = fits.PrimaryHDU(data=dummy_data, header=ref_header)
 
     header = hdu.header
     for i, dim in enumerate(dims, 1):
         header["NAXIS%d" % i] = dim
 
+    # The inputs are read as physical values, so any scaling of theirs is gone
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    header['BITPIX'] = bitpix
+    if bitpix in INT_BLANK:
+        header['BSCALE'] = scaling[0]
+        header['BZERO'] = scaling[1]
+        header['BLANK'] = INT_BLANK[bitpix]
+
+    if region is not None:
+        header['CRPIX1'] = float(ref_header.get('CRPIX1', 1)) - x0
+        header['CRPIX2'] = float(ref_header.get('CRPIX2', 1)) - y0
+    if stokes is not None:
+        header.update(stokes_header(ref_header, stokes))
+
+    # Any checksums of the input do not apply to the cube. Leave a blank card
+    # for every keyword still to be added once the planes are written, so that
+    # the header never has to grow (see LATE_KEYS)
+    for key in ('DATASUM', 'CHECKSUM'):
+        header.remove(key, ignore_missing=True)
+    for key in LATE_KEYS:
+        if key not in header:
+            header.append(fits.Card(), bottom=True)
     header.tofile(outname, overwrite=True)
 
     # create full-sized zero image
     header_size = len(
         header.tostring()
     )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
-    data_size = np.prod(dims) * np.dtype(np.float32).itemsize
+    data_size = np.prod(dims) * dtype.itemsize
     # This is not documented in the example, but appears to be Astropy's default behaviour
     # Pad the total file size to a multiple of the header block size
     block_size = 2880
     data_size = block_size * (((data_size -1) // block_size) + 1)
 
-    with open(outname, "rb+") as f:
-        f.seek(header_size + data_size - 1)
-        f.write(b"\0")
+    allocate_file(outname, header_size + data_size)
+
+
+STOKES_CODES = {'I': 1, 'Q': 2, 'U': 3, 'V': 4,
+                'RR': -1, 'LL': -2, 'RL': -3, 'LR': -4,
+                'XX': -5, 'YY': -6, 'XY': -7, 'YX': -8}
+
+
+def _stokes_value(header, idx):
+    return float(header.get('CRVAL4', 1)) + (idx + 1 - float(header.get('CRPIX4', 1))) * float(header.get('CDELT4', 1))
+
+
+def parse_stokes(spec, header):
+    """
+    Turn a comma separated list of Stokes names (I,Q,U,V,RR,...,YX) or 0-based
+    plane numbers into the plane indices of the input images.
+    """
+
+    nplanes = int(header.get('NAXIS4', 1))
+    values = [_stokes_value(header, idx) for idx in range(nplanes)]
+
+    indices = []
+    for item in spec.split(','):
+        item = item.strip().upper()
+        if item.isdigit():
+            idx = int(item)
+        elif item in STOKES_CODES and STOKES_CODES[item] in values:
+            idx = values.index(STOKES_CODES[item])
+        else:
+            raise ValueError(f"Stokes {item} is not in the input images (planes are {values})")
+
+        if not 0 <= idx < nplanes:
+            raise ValueError(f"Stokes plane {idx} is out of range, the inputs have {nplanes}")
+        indices.append(idx)
+
+    return indices
+
+
+def stokes_header(header, stokes):
+    """
+    Stokes axis keywords for a cube holding only the given input planes. The
+    selected planes must be evenly spaced in Stokes value.
+    """
+
+    values = [_stokes_value(header, idx) for idx in stokes]
+    steps = set(np.diff(values))
+    if len(steps) > 1 or 0 in steps:
+        raise ValueError(f"Selected Stokes {values} are not evenly spaced, split them into separate cubes")
+
+    cdelt4 = steps.pop() if steps else float(header.get('CDELT4', 1))
+    return {"CRPIX4": 1.0, "CRVAL4": values[0], "CDELT4": cdelt4}
+
+
+def parse_region(spec, header):
+    """
+    Turn a region into a 0-based, end-exclusive (y0, y1, x0, x1) pixel box.
+
+    'x0:x1,y0:y1' is a box in pixels of the input images.
+    'sky:ra,dec,width,height' is a box centred on (ra, dec) with the given
+    width and height, all in degrees, and is converted to pixels with the WCS
+    of the input images.
+    """
+
+    xdim, ydim = int(header['NAXIS1']), int(header['NAXIS2'])
+
+    if spec.startswith('sky:'):
+        from astropy.wcs import WCS
+        from astropy.wcs.utils import proj_plane_pixel_scales
+
+        ra, dec, width, height = [float(vv) for vv in spec[4:].split(',')]
+        wcs = WCS(header).celestial
+        xc, yc = wcs.world_to_pixel_values(ra, dec)
+        xscale, yscale = proj_plane_pixel_scales(wcs)
+        x0 = int(np.floor(xc - width / 2 / xscale + 0.5))
+        x1 = int(np.floor(xc + width / 2 / xscale + 0.5)) + 1
+        y0 = int(np.floor(yc - height / 2 / yscale + 0.5))
+        y1 = int(np.floor(yc + height / 2 / yscale + 0.5)) + 1
+    else:
+        xrange, yrange = spec.split(',')
+        x0, x1 = [int(vv) for vv in xrange.split(':')]
+        y0, y1 = [int(vv) for vv in yrange.split(':')]
+
+    x0, x1 = max(x0, 0), min(x1, xdim)
+    y0, y1 = max(y0, 0), min(y1, ydim)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"Region {spec} does not overlap the {xdim}x{ydim} input images")
+
+    return (y0, y1, x0, x1)
+
+
+def allocate_file(fname, size):
+    """
+    Grow fname to size bytes with the blocks actually allocated, rather than
+    leaving a sparse hole that the filesystem has to fill in on first write.
+    Falls back to a sparse extension where posix_fallocate is unavailable.
+    """
+
+    with open(fname, "rb+") as f:
+        current = os.fstat(f.fileno()).st_size
+        if size <= current:
+            return
+
+        try:
+            os.posix_fallocate(f.fileno(), current, size - current)
+        except (AttributeError, OSError):
+            f.seek(size - 1)
+            f.write(b"\0")
+
+
+def read_header_blocks(fitsname):
+    """
+    Read only the 2880-byte header blocks of the primary HDU, up to and
+    including the block holding the END card, and return them as bytes.
+    """
+
+    blocks = []
+    with open(fitsname, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise ValueError(f"No END card found in the header of {fitsname}")
+            blocks.append(block)
+            for ii in range(0, BLOCK_SIZE, 80):
+                if block[ii:ii+8] == b'END     ':
+                    return b''.join(blocks)
+
+
+def get_data_offset(fitsname):
+    """
+    Return the byte offset of the primary data unit, found by scanning the
+    2880-byte header blocks for the END card.
+    """
+
+    return len(read_header_blocks(fitsname))
+
+
+def read_header(fitsname):
+    """
+    Parse the primary header without opening the file through astropy.
+    """
+
+    return fits.Header.fromstring(read_header_blocks(fitsname).decode('ascii'))
+
+
+def get_cube_shape(header):
+    """
+    Return the (stokes, chan, y, x) numpy shape of the output cube.
+    """
+
+    return tuple(int(header[f"NAXIS{ii}"]) for ii in (4, 3, 2, 1))
+
+
+def channel_frequency(header):
+    """
+    Frequency of the (single) channel of an input image.
+    """
+
+    return float(header['CRVAL3']) + (1 - float(header.get('CRPIX3', 1))) * float(header.get('CDELT3', 0))
+
+
+# Keywords that have to agree between all the inputs of one cube
+SCAN_WCS_KEYS = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CDELT1', 'CDELT2',
+                 'CRPIX1', 'CRPIX2', 'CUNIT1', 'CUNIT2', 'CTYPE4', 'CRVAL4', 'CDELT4']
+
+
+def _scan_value(value):
+    """
+    Header value as kept in the scan cache. Numbers, strings and booleans are
+    kept as they are, undefined values become None and anything else (e.g. a
+    complex value) its string, so that every entry can be written to JSON and
+    compares equal once read back.
+    """
+
+    if value is None or isinstance(value, fits.card.Undefined):
+        return None
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def scan_image(im):
+    """
+    Pull the shape, data type, spectral, beam and WCS keywords out of the
+    header blocks of one input image.
+    """
+
+    header = read_header(im)
+    stat = _input_stat(im)
+    naxis = int(header['NAXIS'])
+    stat.update({
+        "shape": [int(header[f"NAXIS{ii}"]) for ii in range(1, naxis + 1)],
+        "bitpix": int(header['BITPIX']),
+        "freq": channel_frequency(header),
+        "cdelt3": float(header.get('CDELT3', 0)),
+        "beam": [_scan_value(header.get(key)) for key in ('BMAJ', 'BMIN', 'BPA')],
+        "wcs": {key: _scan_value(header.get(key)) for key in SCAN_WCS_KEYS},
+    })
+    return stat
+
+
+def scan_cache_name(imlist):
+    return os.path.join(os.path.dirname(os.path.abspath(imlist[0])), '.fitsconcat_scan.json')
+
+
+def scan_images(imlist, workers=16, cache=None):
+    """
+    Scan the headers of all inputs in parallel and return one entry per image
+    (see scan_image), in the order of imlist.
+
+    Entries are cached in a JSON file (by default next to the first input)
+    keyed by path, and reused as long as the size and mtime of the file are
+    unchanged, so repeated runs over the same directory only stat the files.
+    A cache that cannot be read or written is only warned about.
+    """
+
+    if cache is None:
+        cache = scan_cache_name(imlist)
+
+    cached = {}
+    if os.path.exists(cache):
+        try:
+            with open(cache) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as err:
+            print(f"WARNING : ignoring unreadable scan cache {cache} : {err}")
+
+    def _scan(im):
+        stat = _input_stat(im)
+        entry = cached.get(stat["path"])
+        if entry and entry["size"] == stat["size"] and entry["mtime"] == stat["mtime"]:
+            return entry
+        return scan_image(im)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(_scan, imlist))
+
+    cached.update({entry["path"]: entry for entry in scans})
+    try:
+        with open(cache + '.tmp', 'w') as f:
+            json.dump(cached, f)
+        os.replace(cache + '.tmp', cache)
+    except (OSError, TypeError, ValueError) as err:
+        print(f"WARNING : could not write scan cache {cache} : {err}")
+
+    return scans
+
+
+def plan_channels(imlist, sort='freq', workers=16, cache=None):
+    """
+    Build the concat plan from a header scan of the inputs : order the images
+    by frequency (or by name with sort='name') and check that they can go
+    into one cube.
+
+    Inconsistent shapes, data types or spatial WCS raise a ValueError, and
+    gaps in the frequency coverage are reported, all before the output is
+    allocated. Returns the ordered list of images.
+    """
+
+    scans = scan_images(imlist, workers=workers, cache=cache)
+    if sort == 'freq':
+        scans = sorted(scans, key=lambda entry: entry["freq"])
+    else:
+        order = {im: ii for ii, im in enumerate(natural_sort([entry["path"] for entry in scans]))}
+        scans = sorted(scans, key=lambda entry: order[entry["path"]])
+
+    ref = scans[0]
+    errors = []
+    for entry in scans[1:]:
+        for key in ("shape", "bitpix", "wcs"):
+            if entry[key] != ref[key]:
+                errors.append(f"{entry['path']} : {key} {entry[key]} differs from {ref[key]} in {ref['path']}")
+    if errors:
+        raise ValueError("Inputs do not form a single cube :\n" + "\n".join(errors))
+
+    freqs = np.array([entry["freq"] for entry in scans])
+    if len(freqs) > 1:
+        steps = np.diff(freqs)
+        step = np.median(steps)
+        for ii in np.flatnonzero(steps == 0):
+            print(f"WARNING : {scans[ii]['path']} and {scans[ii+1]['path']} have the same frequency")
+        if step > 0:
+            for ii in np.flatnonzero(steps > 1.5 * step):
+                nmissing = int(round(steps[ii] / step)) - 1
+                print(f"WARNING : {nmissing} channels missing between {freqs[ii]:.6g} Hz and {freqs[ii+1]:.6g} Hz")
+
+    return [entry["path"] for entry in scans]
+
+
+class PlaneWriter:
+    """
+    Write (stokes, channel) planes into an existing cube with positional
+    writes, bypassing astropy.
+
+    The plane offsets are worked out from the header once. Planes that are not
+    already in the on-disk type are converted into a single reusable buffer,
+    so every plane is byte-swapped exactly once and no per-plane arrays are
+    allocated.
+
+    For scaled integer cubes (BITPIX 16 or 8) each plane is quantized with
+    whole-plane array operations, with NaNs stored as BLANK.
+
+    write returns the digest of the plane as stored (see plane_digest), so
+    the checksums are computed during the write pass.
+    """
+
+    def __init__(self, outname):
+        header = fits.getheader(outname, ignore_missing_end=True)
+        self.shape = get_cube_shape(header)
+        self.data_offset = get_data_offset(outname)
+        self.bitpix = int(header['BITPIX'])
+        self.dtype = np.dtype(BITPIX_DTYPES[self.bitpix])
+        self.plane_bytes = self.shape[2] * self.shape[3] * self.dtype.itemsize
+        self.buffer = np.empty(self.shape[2:], dtype=self.dtype)
+        if self.bitpix in INT_BLANK:
+            self.bscale = float(header['BSCALE'])
+            self.bzero = float(header['BZERO'])
+            self.scratch = np.empty(self.shape[2:], dtype=np.float32)
+        self.fd = os.open(outname, os.O_WRONLY)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        os.close(self.fd)
+
+    def offset(self, ss, ii):
+        return self.data_offset + (ss * self.shape[1] + ii) * self.plane_bytes
+
+    def encode(self, plane):
+        """
+        Quantize a plane of physical values into the integer buffer.
+        """
+
+        lo, hi = INT_RANGE[self.bitpix]
+        scratch = self.scratch
+        np.subtract(plane, self.bzero, out=scratch)
+        np.multiply(scratch, 1 / self.bscale, out=scratch)
+        np.rint(scratch, out=scratch)
+        np.clip(scratch, lo, hi, out=scratch)
+        np.copyto(scratch, INT_BLANK[self.bitpix], where=np.isnan(plane))
+        self.buffer[...] = scratch
+        return self.buffer
+
+    def write(self, ss, ii, plane):
+        if self.bitpix in INT_BLANK:
+            plane = self.encode(plane)
+        elif plane.dtype != self.dtype or not plane.flags.c_contiguous:
+            self.buffer[...] = plane
+            plane = self.buffer
+
+        buf = memoryview(plane.reshape(-1).view(np.uint8))
+        offset = self.offset(ss, ii)
+        digest = plane_digest(buf, offset - self.data_offset)
+        # pwrite may return short for very large planes
+        while len(buf):
+            nbytes = os.pwrite(self.fd, buf, offset)
+            buf = buf[nbytes:]
+            offset += nbytes
+
+        return digest
+
+
+def ones_complement_sum(data, lead=0):
+    """
+    32-bit ones' complement sum of the big-endian words of data, as used for
+    the FITS DATASUM and CHECKSUM.
+
+    lead is the position of the first byte of data within a 32-bit word of
+    the full data unit, so the sums of pieces written at arbitrary offsets can
+    be added up afterwards with fold_sums, in any order.
+    """
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    trail = -(lead + raw.size) % 4
+    if lead or trail:
+        raw = np.concatenate([np.zeros(lead, np.uint8), raw, np.zeros(trail, np.uint8)])
+
+    return fold_sums([int(raw.view('>u4').sum(dtype=np.uint64))])
+
+
+def fold_sums(sums):
+    """
+    Combine ones' complement sums by folding the carries back in.
+    """
+
+    total = sum(sums)
+    while total >> 32:
+        total = (total & 0xFFFFFFFF) + (total >> 32)
+    return total
+
+
+def shift_sum(value, nbytes):
+    """
+    Ones' complement sum of data that has been moved nbytes further into the
+    data unit. Every byte moves down within its 32-bit word, which rotates
+    the sum right, so moved planes need not be read again.
+    """
+
+    shift = 8 * (nbytes % 4)
+    return ((value >> shift) | (value << (32 - shift))) & 0xFFFFFFFF
+
+
+def encode_checksum(value):
+    """
+    Encode a 32-bit value as the 16 character ASCII string of the FITS
+    checksum convention (Seaman et al.), avoiding punctuation characters.
+    """
+
+    exclude = set(range(0x3a, 0x41)) | set(range(0x5b, 0x61))
+    chars = [0] * 16
+    for ii in range(4):
+        byte = (value >> (24 - 8 * ii)) & 0xFF
+        quad = [byte // 4 + 0x30] * 4
+        quad[0] += byte % 4
+        check = True
+        while check:
+            check = False
+            for jj in (0, 2):
+                if quad[jj] in exclude or quad[jj + 1] in exclude:
+                    quad[jj] += 1
+                    quad[jj + 1] -= 1
+                    check = True
+        for jj in range(4):
+            chars[4 * jj + ii] = quad[jj]
+
+    # the encoded string is rotated right by one character
+    return bytes(chars[-1:] + chars[:-1]).decode('ascii')
+
+
+def plane_digest(plane, offset):
+    """
+    Digest of one plane as stored on disk : its ones' complement sum (at its
+    offset within the data unit) and its CRC32.
+    """
+
+    return {"sum": ones_complement_sum(plane, offset % 4),
+            "crc32": "%08x" % zlib.crc32(plane)}
+
+
+def write_checksums(cube_path, datasum):
+    """
+    Set DATASUM and CHECKSUM in the header of the cube, given the sum of the
+    data unit that was accumulated while the planes were written.
+    """
+
+    data_offset = get_data_offset(cube_path)
+    header = read_header(cube_path)
+    header['DATASUM'] = (str(datasum), 'data unit checksum')
+    header['CHECKSUM'] = ('0' * 16, 'HDU checksum')
+
+    hdrsum = ones_complement_sum(header.tostring().encode('ascii'))
+    header['CHECKSUM'] = encode_checksum(~fold_sums([hdrsum, datasum]) & 0xFFFFFFFF)
+
+    hdrbytes = header.tostring().encode('ascii')
+    if len(hdrbytes) != data_offset:
+        raise ValueError(f"Updated header of {cube_path} does not fit in the existing header blocks")
+
+    with open(cube_path, 'rb+') as f:
+        f.write(hdrbytes)
+
+
+def parse_channels(spec, nchan):
+    """
+    Turn '3', '10:20' or '1,5,10:20' into a list of channel numbers.
+    """
+
+    if spec is None:
+        return list(range(nchan))
+
+    chans = []
+    for item in spec.split(','):
+        if ':' in item:
+            start, stop = item.split(':')
+            chans.extend(range(int(start or 0), int(stop or nchan)))
+        else:
+            chans.append(int(item))
+    return chans
+
+
+def verify_cube(outname, channels=None):
+    """
+    Check the planes of a cube against the per-plane digests in its manifest,
+    reading only the selected channel planes. The header CHECKSUM is checked
+    against the stored DATASUM, and DATASUM against the sum of the plane
+    digests, without reading any data.
+
+    Returns the number of problems found.
+    """
+
+    manifest = load_manifest(outname)
+    if manifest is None:
+        raise ValueError(f"No manifest found for {outname}")
+
+    header = read_header(outname)
+    nstokes, nchan, ydim, xdim = get_cube_shape(header)
+    data_offset = get_data_offset(outname)
+    plane_bytes = ydim * xdim * abs(int(header['BITPIX'])) // 8
+
+    nbad = 0
+    entries = manifest["channels"]
+    if all(entry and "planes" in entry for entry in entries):
+        datasum = fold_sums([plane["sum"] for entry in entries for plane in entry["planes"]])
+        if str(datasum) != str(header.get('DATASUM')):
+            print(f"DATASUM {header.get('DATASUM')} does not match the plane digests ({datasum})")
+            nbad += 1
+    if 'CHECKSUM' in header:
+        hdrsum = ones_complement_sum(header.tostring().encode('ascii'))
+        if fold_sums([hdrsum, int(header['DATASUM'])]) != 0xFFFFFFFF:
+            print("CHECKSUM does not match the header and DATASUM")
+            nbad += 1
+
+    fd = os.open(outname, os.O_RDONLY)
+    try:
+        for ii in parse_channels(channels, nchan):
+            entry = entries[ii]
+            if entry is None or "planes" not in entry:
+                print(f"Channel {ii} : no digest recorded")
+                nbad += 1
+                continue
+            for ss, digest in enumerate(entry["planes"]):
+                offset = (ss * nchan + ii) * plane_bytes
+                plane = os.pread(fd, plane_bytes, data_offset + offset)
+                if plane_digest(plane, offset) != digest:
+                    print(f"Channel {ii} Stokes plane {ss} : digest mismatch")
+                    nbad += 1
+    finally:
+        os.close(fd)
+
+    print(f"Verified {outname} : {nbad} problems found")
+    return nbad
 
 
 def update_fits_header(cube_path, header_dict):
-    # Update the header of the FITS cube
+    """
+    Update keywords in the header of the FITS cube in place.
+
+    The header is written back over the header blocks already on disk, so the
+    data unit is never touched. The updated header must fit into the same
+    number of blocks.
+    """
     # TODO : Fill in the header with the correct values for the entire cube
-    with fits.open(cube_path, memmap=True, ignore_missing_end=True, mode="update") as hdu:
-        header = hdu[0].header
-        for key, value in header_dict.items():
-            header[key] = value
+    data_offset = get_data_offset(cube_path)
+    header = fits.getheader(cube_path, ignore_missing_end=True)
+    for key, value in header_dict.items():
+        header[key] = value
 
+    hdrbytes = header.tostring().encode('ascii')
+    if len(hdrbytes) != data_offset:
+        raise ValueError(f"Updated header of {cube_path} does not fit in the existing header blocks")
 
+    with open(cube_path, 'rb+') as f:
+        f.write(hdrbytes)
 
-def fill_cube_with_images(imlist, nstokes=4, outname='concat.fits'):
+
+def grow_cube(outname, nchan):
     """
-    Fills the empty data cube with fits data.
+    Grow the spectral axis of an existing cube to nchan channels.
 
-    The number of channels in the output cube is assumed to be the length
-    of the input list of images.
+    The channel axis is inside the Stokes axis, so the planes of Stokes 0 stay
+    where they are and the file is simply extended. The planes of any further
+    Stokes are moved up to their new offsets, last Stokes first and back to
+    front, so nothing is overwritten before it has been copied.
+
+    NAXIS3 is updated before the file is extended, so that the header never
+    describes less data than the file holds (which astropy reports as
+    unexpected extra padding).
+
+    Returns the size of a plane in bytes.
+    """
+
+    header = fits.getheader(outname, ignore_missing_end=True)
+    nstokes, old_nchan, ydim, xdim = get_cube_shape(header)
+    data_offset = get_data_offset(outname)
+    plane_bytes = ydim * xdim * abs(header['BITPIX']) // 8
+
+    data_size = nstokes * nchan * plane_bytes
+    data_size = BLOCK_SIZE * (((data_size - 1) // BLOCK_SIZE) + 1)
+
+    update_fits_header(outname, {"NAXIS3": nchan})
+
+    allocate_file(outname, data_offset + data_size)
+
+    chunk = 64 * 1024**2
+    with open(outname, 'rb+') as f:
+        fd = f.fileno()
+        for ss in range(nstokes - 1, 0, -1):
+            src = data_offset + ss * old_nchan * plane_bytes
+            dst = data_offset + ss * nchan * plane_bytes
+            nbytes = old_nchan * plane_bytes
+            for end in range(nbytes, 0, -chunk):
+                start = max(0, end - chunk)
+                os.pwrite(fd, os.pread(fd, end - start, src + start), dst + start)
+
+    return plane_bytes
+
+
+def manifest_name(outname):
+    return outname + '.manifest.json'
+
+
+def load_manifest(outname):
+    """
+    Return the channel manifest of outname, or None if there is no cube or
+    manifest to resume from.
+    """
+
+    mname = manifest_name(outname)
+    if not (os.path.exists(outname) and os.path.exists(mname)):
+        return None
+
+    with open(mname) as f:
+        return json.load(f)
+
+
+def save_manifest(outname, manifest):
+    """
+    Atomically write the channel manifest next to the output cube.
+    """
+
+    mname = manifest_name(outname)
+    with open(mname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(mname + '.tmp', mname)
+
+
+def _input_stat(im):
+    st = os.stat(im)
+    return {"path": os.path.abspath(im), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def prepare_cube(imlist, nstokes=4, outname='concat.fits', append=False, fresh=False,
+                 ref_header=None, stokes=None, region=None, bitpix=-32, scaling=None,
+                 workers=1, window=4):
+    """
+    Create, resume or grow the output cube, and return its channel manifest.
+
+    The manifest records, for every channel plane, the input image it was
+    filled from (path, size, mtime and a CRC32 of the data) and its frequency.
+    Channel entries stay None until the plane has been written.
+
+    Without a manifest (or with fresh=True) a new empty cube is made. If a
+    manifest exists the input list must match it, unless append=True, in
+    which case inputs not yet in the cube are added as new channels at the
+    end of the spectral axis. The append is refused if the new channels
+    would break the frequency order of the cube.
+
+    The Stokes planes and region copied from the inputs are recorded in the
+    manifest too, and must match when resuming.
+
+    For bitpix=16 or 8 the (bscale, bzero) scaling is taken from scaling, or
+    from a streaming pass over the data (see data_range) when it is None. The
+    scaling is fixed when the cube is made, so appended channels that fall
+    outside the original data range are clipped.
+    """
+
+    inputs = [os.path.abspath(im) for im in imlist]
+    manifest = None if fresh else load_manifest(outname)
+
+    if manifest is None:
+        if bitpix in INT_BLANK and scaling is None:
+            print("scanning the data range for the integer scaling")
+            sel = list(range(nstokes)) if stokes is None else stokes
+            scaling = integer_scaling(bitpix, *data_range(imlist, sel, region, workers, window))
+        make_empty_image(imlist, nstokes=nstokes, outname=outname, ref_header=ref_header,
+                         stokes=stokes, region=region, bitpix=bitpix, scaling=scaling)
+
+    stokes = list(range(nstokes)) if stokes is None else list(stokes)
+    region = None if region is None else list(region)
+    if manifest is None:
+        manifest = {"stokes": stokes, "region": region, "bitpix": bitpix,
+                    "inputs": inputs, "channels": [None] * len(inputs)}
+        save_manifest(outname, manifest)
+        return manifest
+
+    if manifest["stokes"] != stokes or manifest["region"] != region:
+        raise ValueError(f"{outname} was built with Stokes planes {manifest['stokes']} and region "
+                         f"{manifest['region']}, use --fresh to rebuild")
+    if manifest["bitpix"] != bitpix:
+        raise ValueError(f"{outname} was built with BITPIX {manifest['bitpix']}, use --fresh to rebuild")
+
+    if not append:
+        if manifest["inputs"] != inputs:
+            raise ValueError(f"Input list differs from {manifest_name(outname)}. "
+                             "Use --append to add channels or --fresh to rebuild.")
+        return manifest
+
+    known = set(manifest["inputs"])
+    new_inputs = [im for im in inputs if im not in known]
+    if not new_inputs:
+        return manifest
+
+    # New channels can only go at the end of the spectral axis, so refuse any
+    # that would break the frequency order of the cube
+    old_freqs = [channel_frequency(read_header(im)) if entry is None else entry["freq"]
+                 for im, entry in zip(manifest["inputs"], manifest["channels"])]
+    new_freqs = [channel_frequency(read_header(im)) for im in new_inputs]
+    if np.all(np.diff(old_freqs) > 0) and np.any(np.diff(old_freqs + new_freqs) <= 0):
+        raise ValueError(f"Appended channels must lie above {max(old_freqs)} Hz, the highest frequency "
+                         f"in {outname}, and be in increasing order. Use --fresh to rebuild.")
+
+    print(f"Appending {len(new_inputs)} channels to {outname}")
+    channels = manifest["channels"]
+    if len(stokes) > 1:
+        # Stokes > 0 planes are moved while growing, so invalidate them until
+        # the move has finished in case we are interrupted half-way.
+        manifest["channels"] = [None] * len(channels)
+        save_manifest(outname, manifest)
+
+    plane_bytes = grow_cube(outname, len(manifest["inputs"]) + len(new_inputs))
+
+    # Stokes plane ss moved up by ss * len(new_inputs) planes, which changes
+    # its ones' complement sum unless that is a whole number of words
+    for entry in channels:
+        if entry is not None and "planes" in entry:
+            for ss, digest in enumerate(entry["planes"][1:], 1):
+                digest["sum"] = shift_sum(digest["sum"], ss * len(new_inputs) * plane_bytes)
+
+    manifest["inputs"] += new_inputs
+    manifest["channels"] = channels + [None] * len(new_inputs)
+    save_manifest(outname, manifest)
+
+    return manifest
+
+
+def channels_to_write(manifest):
+    """
+    Return the (channel, image) pairs whose plane is missing from the cube, or
+    whose input has changed since it was written. Planes whose input has since
+    been removed are left as they are.
+    """
+
+    chans = []
+    for ii, (im, entry) in enumerate(zip(manifest["inputs"], manifest["channels"])):
+        if entry is None:
+            chans.append((ii, im))
+            continue
+
+        if not os.path.exists(im):
+            continue
+
+        stat = _input_stat(im)
+        if entry["size"] != stat["size"] or entry["mtime"] != stat["mtime"]:
+            chans.append((ii, im))
+
+    return chans
+
+
+def _read_channel(im, stokes, region=None):
+    """
+    Read the header and the selected Stokes planes of a channel image in a
+    single pass, and close the file again.
+
+    Only the rows and columns inside region (y0, y1, x0, x1) are read from
+    the memmapped input, so the I/O scales with the size of the cutout.
+    """
+
+    with fits.open(im, memmap=True) as hdu:
+        header = hdu[0].header.copy()
+        if region is None:
+            y0, y1, x0, x1 = 0, header['NAXIS2'], 0, header['NAXIS1']
+        else:
+            y0, y1, x0, x1 = region
+        data = np.stack([hdu[0].section[ss, 0, y0:y1, x0:x1] for ss in stokes])
+
+    return header, data
+
+
+def stream_channels(imlist, stokes=(0,), window=4, region=None):
+    """
+    Yield (header, data) for every image in imlist, in order, with data
+    holding the selected Stokes planes and region.
+
+    At most `window` images are open or held in memory at any time: the one
+    last yielded and window - 1 being read ahead by background threads while
+    the caller writes it out. The next read is only started when the caller
+    asks for the next image, so the caller must let go of the previous data
+    by then (del it at the end of the loop body). Memory and file descriptor
+    use then do not grow with the number of channels.
+    """
+
+    images = iter(imlist)
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = deque(executor.submit(_read_channel, im, stokes, region)
+                        for im in islice(images, window - 1))
+        for im in images:
+            pending.append(executor.submit(_read_channel, im, stokes, region))
+            yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _channel_range_stats(args):
+    """
+    Pool worker : minimum and maximum of the finite values of a set of
+    channels.
+    """
+
+    images, stokes, window, region = args
+
+    lo, hi = np.inf, -np.inf
+    for _, data in stream_channels(images, stokes, window, region):
+        lo = np.fmin(lo, np.fmin.reduce(data, axis=None))
+        hi = np.fmax(hi, np.fmax.reduce(data, axis=None))
+        del data
+
+    return lo, hi
+
+
+def data_range(imlist, stokes=(0,), region=None, workers=1, window=4):
+    """
+    Streaming pass over the inputs to find the range of the data, with the
+    same bounded window (and pool of workers) as the fill.
+    """
+
+    nruns = min(len(imlist), workers * 4)
+    tasks = [(list(run), stokes, window, region) for run in np.array_split(imlist, nruns)]
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            ranges = pool.map(_channel_range_stats, tasks)
+    else:
+        ranges = [_channel_range_stats(task) for task in tasks]
+
+    lo = np.nanmin([rr[0] for rr in ranges])
+    hi = np.nanmax([rr[1] for rr in ranges])
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        raise ValueError("The inputs contain no finite data")
+
+    return float(lo), float(hi)
+
+
+def integer_scaling(bitpix, lo, hi):
+    """
+    BSCALE and BZERO mapping the data range [lo, hi] onto the stored integer
+    range of BITPIX 16 or 8, leaving one value free for BLANK.
+    """
+
+    ilo, ihi = INT_RANGE[bitpix]
+    bscale = (hi - lo) / (ihi - ilo) if hi > lo else 1.0
+    bzero = lo - ilo * bscale
+    return bscale, bzero
+
+
+def _fill_channel_range(args):
+    """
+    Pool worker : write the planes of a set of channels straight into the
+    output cube at their byte offsets.
+
+    Every worker writes a disjoint set of planes, so no locking is required.
+    Returns the manifest entries of the channels that were written.
+    """
+
+    outname, chans, stokes, window, region = args
+
+    written = []
+    with PlaneWriter(outname) as writer:
+        images = [im for _, im in chans]
+        for (ii, im), (header, data) in zip(chans, stream_channels(images, stokes, window, region)):
+            digests = [writer.write(ss, ii, data[ss]) for ss in range(len(stokes))]
+            written.append((ii, _channel_entry(im, header, data, digests)))
+            del data
+
+    return written
+
+
+def _channel_entry(im, header, data, digests):
+    entry = _input_stat(im)
+    entry["checksum"] = "%08x" % zlib.crc32(np.ascontiguousarray(data))
+    entry["freq"] = channel_frequency(header)
+    entry["planes"] = digests
+    return entry
+
+
+def _record_channels(manifest, outname, written, last_save, force=False):
+    """
+    Add freshly written channels to the manifest. The manifest is only saved
+    every MANIFEST_INTERVAL seconds, so it stays cheap with thousands of
+    channels.
+    """
+
+    for ii, entry in written:
+        manifest["channels"][ii] = entry
+
+    if force or time.time() - last_save > MANIFEST_INTERVAL:
+        save_manifest(outname, manifest)
+        return time.time()
+
+    return last_save
+
+
+def fill_cube_in_parallel(chans, manifest, outname='concat.fits', workers=2, window=4):
     """
-    # TODO: debug: if ignore_missing_end is False, throws an error
-    outhdu = fits.open(outname, memmap=True, ignore_missing_end=True, mode="update")
-    outdata = outhdu[0].data
+    Fills the empty data cube using a pool of worker processes.
 
+    The (channel, image) list is split into contiguous runs, and each worker
+    writes its channel planes directly into the pre-allocated output file.
+    The output is byte-identical to the serial path.
 
-    print("Opening all images")
-    fptrlist = []
-    for im in imlist:
-        fptrlist.append(fits.open(im, memmap=True))
+    Each worker streams its inputs with its own window, so at most
+    workers * window input images are open at once.
+    """
+
+    max_chan = int(len(chans))
+    # A few runs per worker so that slow files do not stall the whole pool
+    nruns = min(max_chan, workers * 4)
+    runs = np.array_split(np.arange(max_chan), nruns)
+    tasks = [(outname, [chans[ii] for ii in run], manifest["stokes"], window, manifest["region"])
+             for run in runs]
 
-    max_chan =  int(len(imlist))
     t0 = time.time()
-    for ii in range(0, max_chan):
+    last_save = t0
+    done = 0
+    with Pool(workers) as pool:
+        for written in pool.imap_unordered(_fill_channel_range, tasks):
+            last_save = _record_channels(manifest, outname, written, last_save)
+            done += len(written)
+            print(f"Processed {done}/{max_chan} channels in {time.time() - t0}s", end='\n')
+
+    _record_channels(manifest, outname, [], last_save, force=True)
+
+
+def fill_cube_serial(chans, manifest, outname='concat.fits', window=4, writer='raw'):
+    """
+    Fills the empty data cube one channel at a time.
+
+    writer='raw' writes the planes with a PlaneWriter, writer='memmap' assigns
+    them through an astropy memmap opened in update mode (the original path,
+    kept for benchmarking).
+    """
+
+    if writer == 'memmap':
+        if manifest.get("bitpix", -32) != -32:
+            raise ValueError("The memmap writer only supports float32 output")
+        # TODO: debug: if ignore_missing_end is False, throws an error
+        outhdu = fits.open(outname, memmap=True, ignore_missing_end=True, mode="update")
+        outdata = outhdu[0].data
+        plane_bytes = outdata[0, 0].nbytes
+        nchan = outdata.shape[1]
+    else:
+        outhdu = PlaneWriter(outname)
+
+    max_chan =  int(len(chans))
+    images = [im for _, im in chans]
+    stokes = manifest["stokes"]
+    t0 = time.time()
+    last_save = t0
+    for nn, ((ii, im), (header, data)) in enumerate(zip(chans, stream_channels(images, stokes, window,
+                                                                              manifest["region"])), 1):
         t1 = time.time()
-        print(f"Processing channel {ii}/{max_chan} in {t1 - t0}s", end='\n')
-        for ss in range(nstokes):
-            outdata[ss, ii, :, :] = fptrlist[ii][0].data[ss, 0, :, :]
+        print(f"Processing channel {ii} ({nn}/{max_chan}) in {t1 - t0}s", end='\n')
+        digests = []
+        for ss in range(len(stokes)):
+            if writer == 'memmap':
+                outdata[ss, ii, :, :] = data[ss]
+                digests.append(plane_digest(np.ascontiguousarray(data[ss], dtype='>f4'),
+                                            (ss * nchan + ii) * plane_bytes))
+            else:
+                digests.append(outhdu.write(ss, ii, data[ss]))
+        entry = _channel_entry(im, header, data, digests)
+        last_save = _record_channels(manifest, outname, [(ii, entry)], last_save)
+        del data
 
         t0 = time.time()
 
     outhdu.close()
+    _record_channels(manifest, outname, [], last_save, force=True)
+
+
+def fill_cube_with_images(imlist, nstokes=4, outname='concat.fits', workers=1, window=4,
+                          manifest=None, writer='raw'):
+    """
+    Fills the empty data cube with fits data.
+
+    The number of channels in the output cube is assumed to be the length
+    of the input list of images.
+
+    If a manifest (see prepare_cube) is given, only the channels that are
+    missing or whose input has changed are written, and the manifest is kept
+    up to date as channels complete. The manifest also holds the Stokes
+    planes and region to copy; without one the first nstokes planes of the
+    full images are copied.
+
+    The DATASUM and CHECKSUM keywords are filled in from the per-plane
+    digests recorded while writing, so the cube is never re-read.
+
+    If workers > 1 the channels are written by a pool of processes, see
+    fill_cube_in_parallel. The inputs are streamed through a bounded window
+    of `window` open files, see stream_channels. The parallel path always
+    uses the raw PlaneWriter; see fill_cube_serial for the writer options.
+    """
+
+    if manifest is None:
+        manifest = {"stokes": list(range(nstokes)), "region": None,
+                    "inputs": [os.path.abspath(im) for im in imlist],
+                    "channels": [None] * len(imlist)}
+
+    chans = channels_to_write(manifest)
+    print(f"Writing {len(chans)} of {len(manifest['inputs'])} channels")
+
+    if workers > 1:
+        fill_cube_in_parallel(chans, manifest, outname=outname, workers=workers, window=window)
+    else:
+        fill_cube_serial(chans, manifest, outname=outname, window=window, writer=writer)
+
+    # per-channel frequencies were collected from the input headers while filling
+    freqs = [entry["freq"] for entry in manifest["channels"]]
+    if np.any(np.diff(freqs) <= 0):
+        print("WARNING : channel frequencies are not monotonically increasing")
 
-    # collect per-channel frequencies from input images
-    freqs = [float(fits.getheader(im)['CRVAL3']) for im in imlist]
     nchan = len(freqs)
-    cdelt3 = np.median(np.diff(freqs))  # channel width
+    if nchan > 1:
+        cdelt3 = np.median(np.diff(freqs))  # channel width
+    else:
+        # a single channel keeps the width of its input, copied by make_empty_image
+        cdelt3 = float(read_header(outname).get('CDELT3', 1.0))
     crpix3 = (nchan + 1) // 2                    # integer center channel (1-based)
     crval3 = freqs[0] + (crpix3 - 1) * cdelt3  # frequency at center channel
 
@@ -118,30 +1145,338 @@ def fill_cube_with_images(imlist, nstokes=4, outname='concat.fits'):
 
     update_fits_header(outname, fitsheader)
 
-    print("Closing all images")
-    # Close all images
-    for fptr in fptrlist:
-        fptr.close()
+    # The plane digests add up to the DATASUM whatever order they were written in
+    entries = manifest["channels"]
+    if all("planes" in entry for entry in entries):
+        write_checksums(outname, fold_sums([plane["sum"] for entry in entries for plane in entry["planes"]]))
+    else:
+        print("WARNING : manifest predates plane digests, DATASUM/CHECKSUM not written")
+
+
+def _compress_plane(plane, header, compression_type, dither_seed):
+    """
+    Tile-compress one (1, 1, ny, nx) plane on its own with astropy, as a
+    single tile. Returns the bytes of the empty primary HDU, the header of
+    the compressed table, and the table row (see _table_dtype) and heap.
+    """
+
+    comp = fits.CompImageHDU(data=plane, header=header, compression_type=compression_type,
+                             tile_shape=plane.shape, dither_seed=dither_seed)
+    # astropy takes the data as physical values, so put the scaling back
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        if key in header:
+            comp.header[key] = header[key]
+
+    buf = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), comp]).writeto(buf)
+    raw = buf.getvalue()
+    buf.seek(0)
+    with fits.open(buf, disable_image_compression=True) as hdul:
+        table_header = hdul[1].header.copy()
+        header_offset = hdul.fileinfo(1)['hdrLoc']
+        data_offset = hdul.fileinfo(1)['datLoc']
+
+    heap_offset = data_offset + table_header['NAXIS1'] * table_header['NAXIS2']
+    row = np.frombuffer(raw, dtype=_table_dtype(table_header), count=1, offset=data_offset)
+    heap = raw[heap_offset:heap_offset + table_header['PCOUNT']]
+    return raw[:header_offset], table_header, row, heap
+
+
+def _table_dtype(table_header, huge=None):
+    """
+    Row dtype of a compressed image table : a (count, offset) descriptor for
+    the variable length columns, 64-bit (Q) or 32-bit (P) as in the TFORMs
+    unless huge is given, and a double for ZSCALE/ZZERO.
+    """
+
+    fields = []
+    for ii in range(1, table_header['TFIELDS'] + 1):
+        tform = table_header[f'TFORM{ii}']
+        if tform[1] in 'PQ':
+            wide = tform[1] == 'Q' if huge is None else huge
+            fields.append((table_header[f'TTYPE{ii}'], '>i8' if wide else '>i4', (2,)))
+        else:
+            fields.append((table_header[f'TTYPE{ii}'], '>f8'))
+    return np.dtype(fields)
+
+
+def compress_cube(cubename, outname, compression_type='RICE_1'):
+    """
+    Write a FITS tile-compressed copy of the cube, with one tile per plane.
+
+    Integer cubes are compressed losslessly from their stored values. Float
+    cubes are quantized by the compression (astropy's default quantize
+    level), so use BITPIX 16 or 8 first if the exact values matter.
+
+    The planes are read one at a time and compressed by astropy as a cube of
+    one tile (see _compress_plane), and their compressed bytes are written
+    straight into the heap of the output table. The table rows and header
+    are written last, so the memory use is one plane plus one table row per
+    plane, whatever the size of the cube.
+
+    The table is the one astropy writes for the whole cube with
+    dither_seed=-1 (the dither seed taken from the first plane). The header
+    keeps room for a ZBLANK card until the end, so it may have one more
+    block of blank cards.
+    """
+
+    header = read_header(cubename)
+    # The checksums describe the uncompressed HDU
+    for key in ('CHECKSUM', 'DATASUM'):
+        header.remove(key, ignore_missing=True)
+    nstokes, nchan, ydim, xdim = get_cube_shape(header)
+    dtype = np.dtype(BITPIX_DTYPES[header['BITPIX']])
+    plane_bytes = ydim * xdim * dtype.itemsize
+    data_offset = get_data_offset(cubename)
+    ntiles = nstokes * nchan
+    # The 64-bit descriptors astropy and CFITSIO use above 4 GB of data
+    huge = ntiles * plane_bytes > 2**32
+
+    rows = None
+    zblank = None
+    heap_size = 0
+    seed = -1
+    with open(cubename, 'rb') as fin, open(outname, 'wb') as f:
+        for tile in range(ntiles):
+            plane = np.frombuffer(os.pread(fin.fileno(), plane_bytes, data_offset + tile * plane_bytes),
+                                  dtype=dtype).reshape(1, 1, ydim, xdim)
+            # The dither of tile k uses row k + ZDITHER0, modulo 10000
+            primary, table_header, row, heap = _compress_plane(
+                plane, header, compression_type, seed if seed < 0 else (seed - 1 + tile) % 10000 + 1)
+
+            if rows is None:
+                # The first plane sets the layout of the file : the empty
+                # primary HDU, the table header with room for a ZBLANK card,
+                # the table rows and then the heap
+                seed = table_header.get('ZDITHER0', 1)
+                out_header = table_header.copy()
+                out_header.remove('ZBLANK', ignore_missing=True)
+                spare = out_header.copy()
+                spare['ZBLANK'] = 0
+                header_size = len(spare.tostring())
+                rows = np.zeros(ntiles, dtype=_table_dtype(out_header, huge))
+                maxlen = {name: 0 for name in rows.dtype.names if rows.dtype[name].shape}
+                heap_start = len(primary) + header_size + rows.nbytes
+                f.seek(heap_start)
+
+            if 'ZBLANK' in table_header:
+                zblank = table_header['ZBLANK']
+            for name in rows.dtype.names:
+                if name not in maxlen:
+                    rows[name][tile] = row[name][0]
+                elif row[name][0][0]:
+                    rows[name][tile] = row[name][0][0], heap_size
+                    maxlen[name] = max(maxlen[name], int(row[name][0][0]))
+
+            f.write(heap)
+            heap_size += len(heap)
+
+        f.write(b'\0' * (-(heap_start + heap_size) % BLOCK_SIZE))
+
+        out_header['NAXIS1'] = rows.dtype.itemsize
+        out_header['NAXIS2'] = ntiles
+        out_header['PCOUNT'] = heap_size
+        out_header['ZNAXIS3'] = nchan
+        out_header['ZNAXIS4'] = nstokes
+        for ii in range(1, out_header['TFIELDS'] + 1):
+            name = out_header[f'TTYPE{ii}']
+            if name in maxlen:
+                elem = out_header[f'TFORM{ii}'][2]
+                out_header[f'TFORM{ii}'] = f"1{'Q' if huge else 'P'}{elem}({maxlen[name]})"
+        if zblank is not None:
+            out_header['ZBLANK'] = zblank
+        while len(out_header.tostring()) < header_size:
+            out_header.append()
+
+        f.seek(0)
+        f.write(primary)
+        f.write(out_header.tostring().encode('ascii'))
+        f.write(rows.tobytes())
+
+
+def permute_header_axes(header, order):
+    """
+    Return a copy of header with the FITS axes renumbered. order[i] is the old
+    (1-based) axis number that becomes axis i+1. All per-axis keywords and the
+    PC/CD matrices are renumbered accordingly, and the mandatory SIMPLE,
+    BITPIX and NAXISn cards are put back in the order the standard requires.
+    """
+
+    newnum = {old: new for new, old in enumerate(order, 1)}
+    axis_key = re.compile(r'^(NAXIS|CTYPE|CRVAL|CDELT|CRPIX|CUNIT|CROTA)(\d)$')
+    matrix_key = re.compile(r'^(PC|CD)0*(\d)_0*(\d)$')
+
+    cards = []
+    for card in header.cards:
+        key = card.keyword
+        match = axis_key.match(key)
+        if match and int(match.group(2)) in newnum:
+            key = f"{match.group(1)}{newnum[int(match.group(2))]}"
+        match = matrix_key.match(key)
+        if match and int(match.group(2)) in newnum and int(match.group(3)) in newnum:
+            key = f"{match.group(1)}{newnum[int(match.group(2))]}_{newnum[int(match.group(3))]}"
+        cards.append(fits.Card(key, card.value, card.comment))
+
+    newheader = fits.Header(cards)
+    mandatory = ['SIMPLE', 'BITPIX', 'NAXIS'] + [f"NAXIS{ii}" for ii in range(1, newheader['NAXIS'] + 1)]
+    ordered = fits.Header([newheader.cards[key] for key in mandatory])
+    ordered.extend([card for card in newheader.cards if card.keyword not in mandatory])
+
+    return ordered
+
+
+def make_spectral_major(cubename, outname, max_mem=1024):
+    """
+    Write a copy of the cube in which every pixel's spectrum is contiguous on
+    disk, for rotation measure synthesis and spectral fitting.
+
+    The frequency axis becomes FITS axis 1, so the numpy shape of the output
+    is (stokes, y, x, chan). The transpose is done out of core : the cube is
+    read in blocks of whole rows (or parts of a row, for very long spectra)
+    across all channels, using at most about max_mem MB of RAM, and each
+    transposed block is written with a single positional write.
+    """
+
+    header = fits.getheader(cubename, ignore_missing_end=True)
+    nstokes, nchan, ydim, xdim = get_cube_shape(header)
+    dtype = np.dtype(BITPIX_DTYPES[header['BITPIX']])
+
+    cube = np.memmap(cubename, dtype=dtype, mode='r', offset=get_data_offset(cubename),
+                     shape=(nstokes, nchan, ydim, xdim))
+
+    outheader = permute_header_axes(header, (3, 1, 2, 4))
+    # The checksums no longer match the reordered data
+    for key in ('CHECKSUM', 'DATASUM'):
+        outheader.remove(key, ignore_missing=True)
+    outheader.tofile(outname, overwrite=True)
+    data_offset = len(outheader.tostring())
+    data_size = cube.nbytes
+    data_size = BLOCK_SIZE * (((data_size - 1) // BLOCK_SIZE) + 1)
+    allocate_file(outname, data_offset + data_size)
+
+    # The block is held twice : as read, and transposed
+    pixels = max(1, max_mem * 1024**2 // (2 * nchan * dtype.itemsize))
+    if pixels >= xdim:
+        rows, cols = min(ydim, pixels // xdim), xdim
+    else:
+        rows, cols = 1, pixels
+
+    spectrum_bytes = nchan * dtype.itemsize
+    t0 = time.time()
+    fd = os.open(outname, os.O_WRONLY)
+    try:
+        for ss in range(nstokes):
+            for y0 in range(0, ydim, rows):
+                print(f"Transposing Stokes {ss} rows {y0}/{ydim} in {time.time() - t0}s", end='\n')
+                for x0 in range(0, xdim, cols):
+                    block = cube[ss, :, y0:y0+rows, x0:x0+cols]
+                    block = np.ascontiguousarray(block.transpose(1, 2, 0))
+                    offset = data_offset + ((ss * ydim + y0) * xdim + x0) * spectrum_bytes
+                    buf = memoryview(block.reshape(-1).view(np.uint8))
+                    while len(buf):
+                        nbytes = os.pwrite(fd, buf, offset)
+                        buf = buf[nbytes:]
+                        offset += nbytes
+    finally:
+        os.close(fd)
+        del cube
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Concatenate per-channel FITS images into a single cube.")
-    parser.add_argument("files", nargs="+", help="Input FITS files")
+    parser.add_argument("files", nargs="*", help="Input FITS files")
     parser.add_argument("--nstokes", type=int, default=1,
                         help="Number of Stokes planes (default: 1)")
+    parser.add_argument("--stokes", default=None,
+                        help="Comma separated Stokes to keep, by name (I,Q,U,V,RR,...) or "
+                             "0-based plane number. Overrides --nstokes")
+    parser.add_argument("--region", default=None,
+                        help="Only concatenate a cutout, either a pixel box 'x0:x1,y0:y1' "
+                             "(0-based, end exclusive) or a sky box 'sky:ra,dec,width,height' "
+                             "in degrees")
     parser.add_argument("--output", default="concat.fits",
                         help="Output filename (default: concat.fits)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to fill the cube (default: 1)")
+    parser.add_argument("--window", type=int, default=4,
+                        help="Number of input images open and prefetched at once, "
+                             "per worker (default: 4)")
+    parser.add_argument("--writer", choices=["raw", "memmap"], default="raw",
+                        help="Write planes with positional writes (raw) or through an "
+                             "astropy memmap (memmap, serial only) (default: raw)")
+    parser.add_argument("--bitpix", type=int, choices=[-32, 16, 8], default=-32,
+                        help="Output data type. 16 and 8 store scaled integers with BSCALE/BZERO "
+                             "set from the data range (default: -32)")
+    parser.add_argument("--data-range", type=float, nargs=2, default=None, metavar=("MIN", "MAX"),
+                        help="Data range for the --bitpix 16/8 scaling, skips the pass over the data")
+    parser.add_argument("--compress", default=None,
+                        choices=["RICE_1", "GZIP_1", "GZIP_2", "HCOMPRESS_1", "PLIO_1"],
+                        help="Also write a tile-compressed copy of the cube as <output>.fz")
+    parser.add_argument("--append", action="store_true",
+                        help="Add inputs that are not yet in the output cube as new channels")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Ignore any existing manifest and rebuild the cube from scratch")
+    parser.add_argument("--sort", choices=["freq", "name"], default="freq",
+                        help="Order the channels by frequency from the headers, or by "
+                             "file name (default: freq)")
+    parser.add_argument("--scan-workers", type=int, default=16,
+                        help="Number of threads reading input headers (default: 16)")
+    parser.add_argument("--scan-cache", default=None,
+                        help="Header scan cache (default: .fitsconcat_scan.json next to "
+                             "the first input)")
+    parser.add_argument("--scan-only", action="store_true",
+                        help="Scan and check the inputs, print the channel order and exit")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the planes of --output against the digests in its manifest "
+                             "and exit")
+    parser.add_argument("--channels", default=None,
+                        help="Channels to check with --verify, e.g. '10:20' or '1,5,8' (default: all)")
+    parser.add_argument("--spectral-major", default=None, metavar="NAME",
+                        help="Also write a copy of the cube with each pixel's spectrum "
+                             "contiguous on disk (frequency as the first FITS axis)")
+    parser.add_argument("--max-mem", type=int, default=1024,
+                        help="Memory in MB used for the --spectral-major transpose (default: 1024)")
     args = parser.parse_args()
 
+    if args.verify:
+        sys.exit(1 if verify_cube(args.output, args.channels) else 0)
+    if not args.files:
+        parser.error("no input files given")
+
     t = time.time()
     print("Starting fitsconcat at ", time.time())
 
-    imlist = natural_sort(args.files)
-    print(f"Matched {len(imlist)} files")
-    print("making empty image")
-    make_empty_image(imlist, nstokes=args.nstokes, outname=args.output)
+    print(f"Matched {len(args.files)} files")
+    print("scanning input headers")
+    imlist = plan_channels(args.files, sort=args.sort, workers=args.scan_workers,
+                           cache=args.scan_cache)
+    if args.scan_only:
+        print("\n".join(imlist))
+        sys.exit(0)
+
+    ref_header = read_header(imlist[0])
+    stokes = None if args.stokes is None else parse_stokes(args.stokes, ref_header)
+    region = None if args.region is None else parse_region(args.region, ref_header)
+
+    scaling = None
+    if args.data_range is not None and args.bitpix in INT_BLANK:
+        scaling = integer_scaling(args.bitpix, *args.data_range)
+
+    print("preparing output cube")
+    manifest = prepare_cube(imlist, nstokes=args.nstokes, outname=args.output,
+                            append=args.append, fresh=args.fresh, ref_header=ref_header,
+                            stokes=stokes, region=region, bitpix=args.bitpix,
+                            scaling=scaling, workers=args.workers, window=args.window)
     print("filling cube with images")
-    fill_cube_with_images(imlist, nstokes=args.nstokes, outname=args.output)
+    fill_cube_with_images(imlist, nstokes=args.nstokes, outname=args.output,
+                          workers=args.workers, window=args.window, manifest=manifest,
+                          writer=args.writer)
+    if args.compress:
+        print("writing tile-compressed cube")
+        compress_cube(args.output, args.output + '.fz', compression_type=args.compress)
+    if args.spectral_major:
+        print("writing spectral-major cube")
+        make_spectral_major(args.output, args.spectral_major, max_mem=args.max_mem)
     print("Ending fitsconcat at ", time.time())
     print("Elapsed time is ", time.time() - t)
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+
+import argparse
+import os
+import time
+import numpy as np
+
+from multiprocessing.pool import Pool
+
+from fitsconcat import (BLOCK_SIZE, allocate_file, get_cube_shape, get_data_offset,
+                        parse_channels, read_header)
+
+
+def channel_header(header, chan):
+    """
+    Header of a single-channel image cut from the cube : NAXIS3 = 1 with the
+    spectral reference pixel moved onto the channel.
+    """
+
+    chan_header = header.copy()
+    freq = float(header['CRVAL3']) + (chan + 1 - float(header.get('CRPIX3', 1))) * float(header.get('CDELT3', 0))
+    chan_header['NAXIS3'] = 1
+    chan_header['CRPIX3'] = 1.0
+    chan_header['CRVAL3'] = freq
+    # The cube checksums do not describe the channel
+    for key in ('CHECKSUM', 'DATASUM'):
+        chan_header.remove(key, ignore_missing=True)
+
+    return chan_header
+
+
+def copy_range(src_fd, dst_fd, count, src_offset, dst_offset):
+    """
+    Copy count bytes between two files inside the kernel, with
+    copy_file_range where available, then sendfile, then pread/pwrite.
+    """
+
+    while count > 0:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                nbytes = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+            except OSError:
+                # e.g. EXDEV on older kernels, or filesystems without support
+                nbytes = _sendfile(src_fd, dst_fd, count, src_offset, dst_offset)
+        else:
+            nbytes = _sendfile(src_fd, dst_fd, count, src_offset, dst_offset)
+        if nbytes == 0:
+            raise IOError("Unexpected end of the cube while copying a plane")
+
+        count -= nbytes
+        src_offset += nbytes
+        dst_offset += nbytes
+
+
+def _sendfile(src_fd, dst_fd, count, src_offset, dst_offset):
+    try:
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, src_offset, count)
+    except (AttributeError, OSError):
+        return os.pwrite(dst_fd, os.pread(src_fd, min(count, 64 * 1024**2), src_offset), dst_offset)
+
+
+def channel_name(prefix, chan):
+    return f"{prefix}_chan{chan:04d}.fits"
+
+
+def _split_channel_range(args):
+    """
+    Worker : write the single-channel images for a run of channels, copying
+    each Stokes plane straight from the cube file into the output file.
+    """
+
+    cubename, chans, prefix, overwrite = args
+
+    header = read_header(cubename)
+    nstokes, nchan, ydim, xdim = get_cube_shape(header)
+    plane_bytes = ydim * xdim * abs(int(header['BITPIX'])) // 8
+    cube_offset = get_data_offset(cubename)
+
+    written = []
+    src_fd = os.open(cubename, os.O_RDONLY)
+    try:
+        for ii in chans:
+            outname = channel_name(prefix, ii)
+            if os.path.exists(outname) and not overwrite:
+                raise FileExistsError(f"{outname} exists, use --overwrite to replace it")
+
+            hdrbytes = channel_header(header, ii).tostring().encode('ascii')
+            data_bytes = nstokes * plane_bytes
+            with open(outname, 'wb') as f:
+                f.write(hdrbytes)
+            # The padding of the data unit is left as zeros by the allocation
+            allocate_file(outname, len(hdrbytes) + -(-data_bytes // BLOCK_SIZE) * BLOCK_SIZE)
+
+            dst_fd = os.open(outname, os.O_WRONLY)
+            try:
+                for ss in range(nstokes):
+                    copy_range(src_fd, dst_fd, plane_bytes,
+                               cube_offset + (ss * nchan + ii) * plane_bytes,
+                               len(hdrbytes) + ss * plane_bytes)
+            finally:
+                os.close(dst_fd)
+            written.append(outname)
+    finally:
+        os.close(src_fd)
+
+    return written
+
+
+def split_cube(cubename, prefix=None, channels=None, workers=1, overwrite=False):
+    """
+    Split a cube written by fitsconcat back into one FITS image per channel.
+
+    The planes are copied file to file without going through numpy, so the
+    memory use does not depend on the image size. Scaled integer cubes are
+    split as they are stored, with their BSCALE/BZERO/BLANK.
+    """
+
+    header = read_header(cubename)
+    if int(header['NAXIS']) != 4 or 'FREQ' not in str(header.get('CTYPE3', '')):
+        raise ValueError(f"{cubename} is not a (x, y, freq, stokes) cube")
+
+    _, nchan, _, _ = get_cube_shape(header)
+    chans = parse_channels(channels, nchan)
+    bad = [ii for ii in chans if not 0 <= ii < nchan]
+    if bad:
+        raise ValueError(f"Channels {bad} are outside the cube, which has {nchan} channels")
+
+    if prefix is None:
+        prefix = os.path.splitext(cubename)[0]
+
+    t0 = time.time()
+    if workers > 1 and len(chans) > 1:
+        runs = np.array_split(chans, min(len(chans), workers * 4))
+        tasks = [(cubename, [int(ii) for ii in run], prefix, overwrite) for run in runs]
+        done = 0
+        with Pool(workers) as pool:
+            for written in pool.imap_unordered(_split_channel_range, tasks):
+                done += len(written)
+                print(f"Written {done}/{len(chans)} channels in {time.time() - t0}s")
+    else:
+        for ii in chans:
+            _split_channel_range((cubename, [ii], prefix, overwrite))
+        print(f"Written {len(chans)} channels in {time.time() - t0}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Split a FITS cube made by fitsconcat into per-channel images.")
+    parser.add_argument("cube", help="Input FITS cube")
+    parser.add_argument("--prefix", default=None,
+                        help="Output name prefix, images are written as <prefix>_chanNNNN.fits "
+                             "(default: the cube name without extension)")
+    parser.add_argument("--channels", default=None,
+                        help="Channels to write, e.g. '10:20' or '1,5,8' (default: all)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes writing images (default: 1)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Replace existing output images")
+    args = parser.parse_args()
+
+    split_cube(args.cube, args.prefix, args.channels, args.workers, args.overwrite)
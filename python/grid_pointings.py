@@ -1,28 +1,111 @@
 #!/usr/bin/env python3
 
 import click
+import sys
 import numpy as np
 from astropy.coordinates import SkyCoord
-from astropy.coordinates import Angle
+from astropy.units import UnitsError
 
-import matplotlib.pyplot as plt
+# Pointings formatted at a time by the writers, and their file buffer size
+WRITE_CHUNK = 65536
+WRITE_BUFFER = 1 << 20
 
 
-def get_angle_pieces(angle, which):
-    if which == 'ra':
-        a = int(np.floor(angle.hour))
-        delta = angle.hour - a
-    elif which == 'dec':
-        a = int(np.floor(angle.deg))
-        delta = angle.deg - a
-    else:
-        raise ValueError("Invalid value for 'which'")
+def format_sexagesimal(values, hours=False, precision=2, seps='::', plus=False):
+    """
+    Format an array of angles in degrees as sexagesimal strings in one pass,
+    as hours (hours=True, wrapped to [0, 24h)) or degrees.
+
+    The angles are rounded once to integer units of the last decimal of the
+    seconds, so the seconds never read 60, and the sign is taken from the
+    angle itself, so -0.5 degrees is -00:30:00.00. seps holds the separator
+    after the hours/degrees and after the minutes, and an optional third one
+    after the seconds, e.g. 'hms'.
+    """
+
+    values = np.asarray(values, dtype=float)
+    if hours:
+        values = np.mod(values, 360.) / 15.
+
+    scale = 10**precision
+    total = np.round(np.abs(values) * 3600 * scale).astype(np.int64)
+    if hours:
+        total %= 24 * 3600 * scale
+    whole, frac = np.divmod(total, scale)
+    signs = np.where((values < 0) & (total > 0), '-', '+' if plus else '')
+
+    secfmt = f'%02d.%0{precision}d' if precision else '%02d'
+    fmt = f'%s%02d{seps[0]}%02d{seps[1]}{secfmt}{seps[2:]}'
+    columns = [signs.tolist(), (whole // 3600).tolist(), (whole // 60 % 60).tolist(), (whole % 60).tolist()]
+    if precision:
+        columns.append(frac.tolist())
+    return [fmt % row for row in zip(*columns)]
 
-    m = int(np.floor(delta * 60.))
-    delta = delta*60. - m
-    s = delta * 60.
 
-    return a,m,s
+def grid_positions(ra0, dec0, npoint, sep):
+    """
+    RA and DEC (degrees) of an npoint x npoint grid of pointings spaced by
+    sep arcmin around (ra0, dec0), computed in one go.
+
+    The grid is regular in the tangent plane at the centre, and the offsets
+    are projected back onto the sky with the exact inverse gnomonic
+    projection. The pointings are ordered as before, RA offset in the outer
+    loop, DEC offset in the inner one, both counting down from +halfn * sep.
+    """
+
+    halfn = npoint//2
+    offsets = np.radians((np.arange(npoint) - halfn) * sep / 60.)
+    # Tangent plane coordinates, xi towards increasing RA, eta towards the north pole
+    xi, eta = np.meshgrid(-offsets, -offsets, indexing='ij')
+    xi = xi.ravel()
+    eta = eta.ravel()
+
+    ra0 = np.radians(ra0)
+    dec0 = np.radians(dec0)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+
+    return np.mod(np.degrees(ra), 360.), np.degrees(dec)
+
+
+def write_kat(ra_list, dec_list, srcprefix='', fname='katopt.csv'):
+    """
+    Write the pointings as a katpoint target list.
+    """
+
+    line = srcprefix.replace('%', '%%') + '%03d, radec target, %s, %s\n'
+    with open(fname, 'w', buffering=WRITE_BUFFER) as ffile:
+        ffile.write('# name, tags, ra, dec (J2000)\n')
+        for start in range(0, len(ra_list), WRITE_CHUNK):
+            ras = format_sexagesimal(ra_list[start:start + WRITE_CHUNK], hours=True)
+            decs = format_sexagesimal(dec_list[start:start + WRITE_CHUNK])
+            ffile.writelines(line % row for row in zip(range(start, start + len(ras)), ras, decs))
+
+
+def write_vla(ra_list, dec_list, srcprefix='', groupid='', fname='vlaopt.csv'):
+    """
+    Write the pointings as a VLA OPT source catalog.
+    """
+
+    line = (srcprefix.replace('%', '%%') + '%03d;' + str(groupid).replace('%', '%%')
+            + ';Equatorial;J2000;%s;%s;LSRK;Radio;0.0; ;\n')
+    with open(fname, 'w', buffering=WRITE_BUFFER) as ffile:
+        for start in range(0, len(ra_list), WRITE_CHUNK):
+            ras = format_sexagesimal(ra_list[start:start + WRITE_CHUNK], hours=True)
+            decs = format_sexagesimal(dec_list[start:start + WRITE_CHUNK])
+            ffile.writelines(line % row for row in zip(range(start, start + len(ras)), ras, decs))
+
+
+def print_positions(ra_list, dec_list, ffile=sys.stdout):
+    """
+    Print the pointings as 'XXhXXmXX.XXXXs +XXdXXmXX.XXXs', one per line.
+    """
+
+    for start in range(0, len(ra_list), WRITE_CHUNK):
+        ras = format_sexagesimal(ra_list[start:start + WRITE_CHUNK], hours=True, precision=4, seps='hms')
+        decs = format_sexagesimal(dec_list[start:start + WRITE_CHUNK], precision=3, seps='dms', plus=True)
+        ffile.writelines('%s %s\n' % row for row in zip(ras, decs))
 
 
 @click.command()
@@ -33,7 +116,8 @@ def get_angle_pieces(angle, which):
 @click.option('--opt', nargs=1, type=click.Choice(['VLA', 'KAT'], case_sensitive=False))
 @click.option('--srcprefix', type=str, default='', help='Prefix for source names in grid')
 @click.option('--groupid', type=str, default=None, help='Group ID to use for --opt=VLA')
-def grid_pointings(target_ra, target_dec, npoint, sep, opt, srcprefix, groupid):
+@click.option('--no-plot', is_flag=True, help='Do not plot the grid, e.g. when running headless')
+def grid_pointings(target_ra, target_dec, npoint, sep, opt, srcprefix, groupid, no_plot):
     """
     Script to generate the pointing positions to sample an NxN grid around a
     given target location.
@@ -46,8 +130,8 @@ def grid_pointings(target_ra, target_dec, npoint, sep, opt, srcprefix, groupid):
 
     SEP is the separation (in arcmin) between each pointing.
 
-    WARNING : This script uses the *linear* approximation to angle offsets, so
-    it will start accumulating large errors for large offsets.
+    The grid is laid out in the tangent plane at the central pointing, so the
+    offsets are exact on the sphere for any grid size.
     """
 
     if opt is not None:
@@ -67,60 +151,22 @@ def grid_pointings(target_ra, target_dec, npoint, sep, opt, srcprefix, groupid):
             msg = 'Coordinates must be in hexagesimal or decimal degrees. Format not recognized.'
             raise ValueError(msg)
 
-    halfn = npoint//2
-
-    if npoint % 2:
-        do_central_pointing = True
-    else:
-        do_central_pointing = False
-
-    new_pos_list = []
-    for rr in range(npoint):
-        dra = Angle((rr - halfn) * sep, unit='arcmin')
-        for dd in range(npoint):
-            ddec = Angle((dd - halfn) * sep, unit='arcmin')
-
-            new_dec = ph_centre.dec - ddec
-            avg_dec = (ph_centre.dec.degree + new_dec.degree)/2.
-            # Account for spherical change
-            new_ra = (ph_centre.ra - dra) * np.cos(np.deg2rad(avg_dec))
-
-            new_pos = SkyCoord(new_ra, new_dec)
-            new_pos_list.append(new_pos)
+    ra_list, dec_list = grid_positions(ph_centre.ra.deg, ph_centre.dec.deg, npoint, sep)
 
     if opt == 'kat':
-        ffile = open('katopt.csv', 'w')
-        ffile.write('# name, tags, ra, dec (J2000)\n')
-        for idx, nn in enumerate(new_pos_list):
-            ffile.write('%s%03d, ' % (srcprefix, idx))
-            ffile.write('radec target, ')
-
-            rh, rm, rs = get_angle_pieces(nn.ra, 'ra')
-            dd, dm, ds = get_angle_pieces(nn.dec, 'dec')
-
-            ffile.write('%02d:%02d:%.2f, %02d:%02d:%.2f\n' % (rh, rm, rs, dd, dm, ds))
-        ffile.close()
+        write_kat(ra_list, dec_list, srcprefix)
     elif opt == 'vla':
-        ffile = open('vlaopt.csv', 'w')
-        for idx, nn in enumerate(new_pos_list):
-
-            rh, rm, rs = get_angle_pieces(nn.ra, 'ra')
-            dd, dm, ds = get_angle_pieces(nn.dec, 'dec')
-
-            ffile.write('%s%03d;%s;' % (srcprefix, idx, groupid))
-            ffile.write('Equatorial;J2000;')
-            ffile.write('%02d:%02d:%.2f;%02d:%02d:%.2f;' % (rh, rm, rs, dd, dm, ds))
-            ffile.write('LSRK;Radio;0.0; ;\n')
+        write_vla(ra_list, dec_list, srcprefix, groupid)
     else:
-        for nn in new_pos_list:
-                print(nn.to_string('hmsdms'))
-
-    plt.scatter([nn.ra.deg for nn in new_pos_list], [nn.dec.deg for nn in new_pos_list])
-    plt.xlabel("RA (deg)")
-    plt.ylabel("DEC (deg)")
-    plt.show()
+        print_positions(ra_list, dec_list)
 
+    if not no_plot:
+        import matplotlib.pyplot as plt
 
+        plt.scatter(ra_list, dec_list)
+        plt.xlabel("RA (deg)")
+        plt.ylabel("DEC (deg)")
+        plt.show()
 
 
 if __name__ == '__main__':
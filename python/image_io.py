@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+
+import itertools
+import os
+import shutil
+import numpy as np
+
+BLOCK_SIZE = 2880
+
+
+def is_casa_image(name):
+    """
+    CASA images are directories, anything else is taken as FITS.
+    """
+
+    return os.path.isdir(name)
+
+
+def plane_indices(shape):
+    """
+    Indices along all the axes after the first two (channel, Stokes, ...)
+    of every plane in an image of the given shape.
+    """
+
+    return itertools.product(*[range(nn) for nn in shape[2:]])
+
+
+class FitsImage:
+    """
+    Primary HDU of a FITS file, memory mapped through astropy so that only
+    the planes that are read or written are touched.
+
+    The shape and plane indices are in the FITS (and CASA) axis order,
+    NAXIS1 first, and planes are returned as (NAXIS1, NAXIS2) arrays.
+    """
+
+    def __init__(self, name, mode='readonly'):
+        from astropy.io import fits
+
+        self.name = name
+        self.hdul = fits.open(name, mode=mode, memmap=True)
+        self.header = self.hdul[0].header
+        self.data = self.hdul[0].data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def shape(self):
+        return list(self.data.shape[::-1])
+
+    def get_plane(self, index):
+        return np.array(self.data[tuple(index[::-1])].T)
+
+    def put_plane(self, index, plane):
+        self.data[tuple(index[::-1])] = plane.T
+
+    def close(self):
+        self.hdul.close()
+
+
+class CasaImage:
+    """
+    CASA image through a casatools image tool, with the same interface as
+    FitsImage. casatools is only imported when a CASA image is opened.
+    """
+
+    def __init__(self, name, mode='readonly'):
+        from casatools import image
+
+        self.name = name
+        self.ia = image()
+        self.ia.open(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def shape(self):
+        return list(self.ia.shape())
+
+    def get_plane(self, index):
+        nx, ny = self.shape[:2]
+        return self.ia.getchunk(blc=[0, 0, *index], trc=[nx - 1, ny - 1, *index]).reshape(nx, ny)
+
+    def put_plane(self, index, plane):
+        self.ia.putchunk(plane.reshape(plane.shape + (1,) * len(index)), blc=[0, 0, *index])
+
+    def close(self):
+        self.ia.close()
+
+
+def open_image(name, mode='readonly'):
+    """
+    Open a FITS or CASA image, mode is 'readonly' or 'update'.
+    """
+
+    if is_casa_image(name):
+        return CasaImage(name, mode)
+    return FitsImage(name, mode)
+
+
+def remove_image(name):
+    if is_casa_image(name):
+        shutil.rmtree(name)
+    elif os.path.exists(name):
+        os.remove(name)
+
+
+def create_fits(name, shape, header):
+    """
+    Write a float32 FITS image of the given shape (NAXIS1 first) with the
+    WCS and other keywords of header. Only the header is written, the data
+    unit is allocated (see fitsconcat.allocate_file) and reads as zeros.
+    """
+
+    from astropy.io import fits
+    from fitsconcat import allocate_file
+
+    hdu = fits.PrimaryHDU(data=np.zeros((1,) * len(shape), dtype=np.float32), header=header)
+    header = hdu.header
+    for ii, dim in enumerate(shape, 1):
+        header['NAXIS%d' % ii] = int(dim)
+    for key in ('BSCALE', 'BZERO', 'BLANK', 'DATASUM', 'CHECKSUM'):
+        header.remove(key, ignore_missing=True)
+    header.tofile(name, overwrite=True)
+
+    data_size = int(np.prod(shape)) * 4
+    data_size = BLOCK_SIZE * ((data_size + BLOCK_SIZE - 1) // BLOCK_SIZE)
+    allocate_file(name, len(header.tostring()) + data_size)
+
+
+def create_casa(name, shape, like):
+    """
+    Create a CASA image of the given shape with the coordinates, brightness
+    unit, restoring beam and miscinfo of the CasaImage like, and its pixel
+    masks when the shapes match. The pixels are set to zero by fromshape,
+    they are all expected to be written afterwards.
+    """
+
+    from casatools import image
+
+    ia = image()
+    ia.fromshape(outfile=name, shape=list(shape), csys=like.ia.coordsys().torecord(), overwrite=True)
+    ia.setbrightnessunit(like.ia.brightnessunit())
+    if like.ia.restoringbeam():
+        ia.setrestoringbeam(imagename=like.name)
+    ia.setmiscinfo(like.ia.miscinfo())
+
+    if list(shape) == like.shape:
+        for mask in like.ia.maskhandler('get'):
+            if mask:
+                ia.maskhandler('copy', [f"{like.name}:{mask}", mask])
+        default = like.ia.maskhandler('default')[0]
+        if default:
+            ia.maskhandler('set', [default])
+    ia.close()
+
+
+def create_like(name, like, shape=None, header=None):
+    """
+    Create the image name with the backend, shape and header (or coordinate
+    system) of the open image like, without copying its pixels, and return
+    it open for writing. shape, and for FITS header, replace those of like
+    when given.
+    """
+
+    if shape is None:
+        shape = like.shape
+
+    if isinstance(like, CasaImage):
+        create_casa(name, shape, like)
+    else:
+        create_fits(name, shape, like.header if header is None else header)
+
+    return open_image(name, mode='update')
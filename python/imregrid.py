@@ -1,15 +1,13 @@
 #!/usr/bin/env python3
 
+import copy
 import os
 import sys
-import shutil
 
 import click
 import numpy as np
 
-from casatasks import imregrid
-from casatools import image
-ia = image()
+from image_io import create_like, is_casa_image, open_image, plane_indices, remove_image
 
 import logging
 
@@ -27,9 +25,118 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
-def wipe_file(filename):
-    if os.path.exists(filename):
-        shutil.rmtree(filename)
+# Radians to the direction units of a CASA coordinate system
+RAD_TO_UNIT = {'rad': 1., 'deg': 180 / np.pi, "'": 180 * 60 / np.pi, '"': 180 * 3600 / np.pi}
+# Celestial WCS keywords taken from the template for the FITS backend
+CELESTIAL_KEYS = ('CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2',
+                  'CUNIT1', 'CUNIT2', 'LONPOLE', 'LATPOLE', 'RADESYS', 'EQUINOX')
+
+
+def centre_pixel(shape):
+    """
+    0-based pixel the target is re-centred on.
+    """
+
+    if shape[0] % 2:
+        return [shape[0]//2 + 1, shape[1]//2 + 1]
+    else:
+        return [shape[0]//2, shape[1]//2]
+
+
+def is_celestial_key(key, matrix_only=False):
+    """
+    Whether key is one of the celestial WCS keywords (the PC or CD matrix
+    only with matrix_only).
+    """
+
+    if key[:2] in ('PC', 'CD') and key[2:] in ('1_1', '1_2', '2_1', '2_2'):
+        return True
+    return not matrix_only and key in CELESTIAL_KEYS
+
+
+def regrid_casa(template, target, outname):
+    """
+    Regrid with the CASA task. The target is moved to the template centre,
+    with its centre pixel at the template reference value, and interpolated
+    onto the template grid.
+
+    Rather than copying the target to change its coordinates, it is regridded
+    onto the template grid moved to the world position of its centre pixel,
+    and the output is then moved back to the template centre. This is the
+    same pixel mapping as setting the target's CRPIX to its centre pixel
+    when that already is its reference pixel. Otherwise the target keeps its
+    own projection centre rather than being re-projected about its centre
+    pixel, which differs by the projection distortion between the two.
+    """
+
+    from casatasks import imregrid
+    from casatools import image
+
+    templatecoord = imregrid(template)
+
+    ia = image()
+    ia.open(target)
+    csys = ia.coordsys()
+    pixel = csys.referencepixel()['numeric']
+    pixel[:2] = centre_pixel(ia.shape())
+    world = csys.toworld(pixel, format='m')['measure']['direction']
+    ia.close()
+
+    units = templatecoord['csys']['direction0']['units']
+    shifted = copy.deepcopy(templatecoord)
+    shifted['csys']['direction0']['crval'] = np.array([world['m0']['value'] * RAD_TO_UNIT[units[0]],
+                                                       world['m1']['value'] * RAD_TO_UNIT[units[1]]])
+
+    imregrid(target, template=shifted, output=outname, overwrite=True, axes=[0,1], interpolation='cubic', decimate=10)
+
+    ia.open(outname)
+    outcsys = ia.coordsys().torecord()
+    for key in ('crval', 'latpole', 'longpole'):
+        outcsys['direction0'][key] = templatecoord['csys']['direction0'][key]
+    ia.setcoordsys(outcsys)
+    ia.close()
+
+
+def regrid_fits(template, target, outname):
+    """
+    Regrid FITS images with reproject, plane by plane. The target is moved
+    to the template centre as in regrid_casa, by editing its header only,
+    and the output is created directly with the template grid.
+    """
+
+    try:
+        from reproject import reproject_interp
+    except ImportError:
+        raise click.ClickException("The FITS backend needs the reproject package")
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    template_header = fits.getheader(template)
+
+    with open_image(target) as inp:
+        header = inp.header.copy()
+        crpix = centre_pixel(inp.shape)
+        header['CRPIX1'], header['CRPIX2'] = crpix[0] + 1, crpix[1] + 1
+        header['CRVAL1'], header['CRVAL2'] = template_header['CRVAL1'], template_header['CRVAL2']
+        for key in ('LONPOLE', 'LATPOLE'):
+            if key in template_header:
+                header[key] = template_header[key]
+        in_wcs = WCS(header).celestial
+
+        # The output header is the target one with the template's celestial axes
+        shape = [template_header['NAXIS1'], template_header['NAXIS2']] + inp.shape[2:]
+        out_wcs = WCS(template_header).celestial
+        for key in [key for key in header if is_celestial_key(key, matrix_only=True)]:
+            del header[key]
+        for key in template_header:
+            if is_celestial_key(key):
+                header[key] = template_header[key]
+
+        with create_like(outname, inp, shape=shape, header=header) as out:
+            for index in plane_indices(shape):
+                plane, _ = reproject_interp((inp.get_plane(index).T, in_wcs), out_wcs,
+                                            shape_out=(shape[1], shape[0]), order='bicubic')
+                out.put_plane(index, plane.T)
 
 
 ctx = dict(help_option_names=['-h', '--help'])
@@ -37,77 +144,41 @@ ctx = dict(help_option_names=['-h', '--help'])
 @click.argument('template', type=click.Path(exists=True))
 @click.argument('target', type=click.Path(exists=True))
 @click.option('-f', '--force', 'do_force', is_flag=True, help='Force overwriting output if already exists.')
-def do_imregrid(template, target, do_force):
+@click.option('--backend', type=click.Choice(['auto', 'casa', 'fits']), default='auto', show_default=True,
+              help='CASA imregrid, or reproject for FITS images (auto: fits when both images are FITS)')
+def do_imregrid(template, target, do_force, backend):
     """
 
-    Run the CASA task imregrid to scale the TARGET image to match the TEMPLATE
-    image.
-
-    The input images can be either FITS images or CASA images.
+    Regrid the TARGET image to match the TEMPLATE image, after moving the
+    TARGET to the TEMPLATE centre.
 
-    This script depends on CASA 6.
+    The input images can be either FITS images or CASA images. CASA images
+    need CASA 6, FITS images can be regridded without it with reproject.
     """
 
-    target_name, ext = os.path.splitext(target)
+    target_name, ext = os.path.splitext(target.rstrip('/'))
     outname = target_name + '_scaled' + ext
 
     if os.path.exists(outname):
         if do_force:
             print(f"WARNING : Image {outname} exists, forcing overwrite")
+            remove_image(outname)
         else:
             print(f"Image {outname} exists, --force not passed, not overwriting.")
             print(f"Exiting.")
             exit(0)
 
-    ia.open(template)
-    template_shape = ia.shape()
-    ia.close()
-
-    templatecoord = imregrid(template)
+    if backend == 'auto':
+        backend = 'casa' if is_casa_image(template) or is_casa_image(target) else 'fits'
+    if backend == 'fits' and (is_casa_image(template) or is_casa_image(target)):
+        raise click.UsageError("The FITS backend needs FITS images")
 
-    ia.open(target)
-    target_shape = ia.shape()
-    outcsys = ia.coordsys().torecord()
-    ia.close()
-
-    if target_shape[0] % 2:
-        crpix = [target_shape[0]//2 + 1, target_shape[1]//2 + 1]
+    logger.info(f"Regridding {target} onto {template} with the {backend} backend")
+    if backend == 'fits':
+        regrid_fits(template, target, outname)
     else:
-        crpix = [target_shape[0]//2, target_shape[1]//2]
-
-    target_units = outcsys['direction0']['units']
-    template_units = templatecoord['csys']['direction0']['units']
-
-    # make sure units match before regridding, otherwise it will fail
-    if template_units[0] == target_units[0]:
-        pass
-    elif template_units[0] == "'" and target_units[0] == 'rad':
-        # Convert from rad to arcmin
-        outcsys['direction0']['units'] = template_units
-        outcsys['direction0']['cdelt'] *= (180/np.pi)
-        outcsys['direction0']['cdelt'] *= 60.
-    elif template_units[0] == "rad" and target_units[0] == "'":
-        # Convert from arcmin to rad
-        outcsys['direction0']['units'] = template_units
-        outcsys['direction0']['cdelt'] /= 60.
-        outcsys['direction0']['cdelt'] *= (np.pi/180.)
-
-    outcsys['direction0']['crpix'] = np.asarray(crpix).astype(int)
-    outcsys['direction0']['crval'] = templatecoord['csys']['direction0']['crval']
-    outcsys['direction0']['latpole'] = templatecoord['csys']['direction0']['latpole']
-    outcsys['direction0']['longpole'] = templatecoord['csys']['direction0']['longpole']
-
-    tmpname = 'tmp.im'
-    wipe_file(tmpname)
-    shutil.copytree(target, tmpname)
-
-    ia.open(tmpname)
-    ia.setcoordsys(outcsys)
-    ia.close()
-
-    imregrid(tmpname, template=templatecoord, output=outname, overwrite=True, axes=[0,1], interpolation='cubic', decimate=10)
-
-    wipe_file(tmpname)
+        regrid_casa(template, target, outname)
+    logger.info(f"Wrote {outname}")
 
 
 if __name__ == '__main__':
@@ -1,9 +1,21 @@
 #! /usr/bin/env python
 
 import argparse
+import csv
+import hashlib
+import os
+import sys
+import numpy as np
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
+from catalog_utils import CACHE_DIR, parse_positions, unit_vectors
+
+# Number of sources matched and written at a time in batch mode
+BATCH_CHUNK = 100000
+# Version of the depth map cache (see catalog_utils), for the beam model and the grid layout
+DEPTH_MAP_VERSION = 1
+
 # (capture_block_id, field_name, ra_deg, dec_deg)
 MIGHTEE_POINTINGS = [
     (1523464709, "COSMOS", 150.11917, 2.20583),
@@ -189,16 +201,254 @@ def mightee_search(ra_str, dec_str, top=3):
         print(f"{cb:<16} {name:<20} {ra:>12.5f} {dec:>12.5f} {seps[i].to(u.arcmin):>12.4f}")
 
 
+def pointing_tree():
+    """KD-tree over the unit vectors of MIGHTEE_POINTINGS, built once per batch."""
+    from scipy.spatial import cKDTree
+
+    return cKDTree(unit_vectors([p[2] for p in MIGHTEE_POINTINGS], [p[3] for p in MIGHTEE_POINTINGS]))
+
+
+def read_positions(fname, ra_col=None, dec_col=None):
+    """
+    Read RA/DEC columns (degrees, or HMS/DMS strings) from a CSV or FITS
+    table. Without explicit names the first column called ra/dec (any
+    case) is used. Decimal values are degrees even in a text column, as
+    for a single position (see catalog_utils.parse_positions).
+    """
+    from astropy.table import Table
+
+    fmt = "fits" if fname.lower().endswith((".fits", ".fit", ".fits.gz")) else "ascii.csv"
+    table = Table.read(fname, format=fmt)
+
+    def find(name, default):
+        if name is not None:
+            return name
+        for col in table.colnames:
+            if col.lower() == default:
+                return col
+        raise ValueError(f"No '{default}' column in {fname}, use --ra-col/--dec-col")
+
+    ra = table[find(ra_col, "ra")]
+    dec = table[find(dec_col, "dec")]
+    if ra.dtype.kind in "fiu" and dec.dtype.kind in "fiu":
+        return np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+
+    return parse_positions(np.asarray(ra).astype(str), np.asarray(dec).astype(str))
+
+
+def meerkat_lband_beam(sep_arcmin, freq_ghz=1.284):
+    """
+    MeerKAT L-band primary beam power, the cosine-taper model of Mauch et al.
+    (2020) : A = [cos(1.189 pi r / FWHM) / (1 - 4 (1.189 r / FWHM)^2)]^2,
+    with FWHM = 57.5 arcmin (nu / 1.5 GHz)^-1. Set to zero beyond the first
+    null.
+    """
+    fwhm = 57.5 * 1.5 / freq_ghz
+    x = 1.189 * np.asarray(sep_arcmin, dtype=float) / fwhm
+    denom = 1 - 4 * x**2
+    # The 0/0 at x = 0.5 has the limit pi/4
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beam = np.where(np.abs(denom) < 1e-6, np.pi / 4, np.cos(np.pi * x) / denom) ** 2
+    return np.where(x < 1.5, beam, 0.)
+
+
+def depth_map_name(freq_ghz, cell_arcmin):
+    key = repr((DEPTH_MAP_VERSION, MIGHTEE_POINTINGS, freq_ghz, cell_arcmin)).encode()
+    return os.path.join(CACHE_DIR, f"mightee_depth_{hashlib.sha1(key).hexdigest()[:16]}.npz")
+
+
+def depth_grid_shape(cell_arcmin):
+    """
+    The depth map is an equal-area grid, regular in RA and sin(DEC), with
+    square cells of cell_arcmin on the equator.
+    """
+    cell = np.radians(cell_arcmin / 60.)
+    return int(np.ceil(2 * np.pi / cell)), int(np.ceil(2 / cell))
+
+
+def depth_cells(ra_deg, dec_deg, shape):
+    nx, ny = shape
+    ix = np.floor(np.mod(ra_deg, 360.) / 360. * nx).astype(np.int64) % nx
+    iy = np.clip(np.floor((np.sin(np.radians(dec_deg)) + 1) / 2 * ny).astype(np.int64), 0, ny - 1)
+    return iy * nx + ix
+
+
+def build_depth_map(freq_ghz=1.284, cell_arcmin=1.0):
+    """
+    Relative depth sqrt(sum A^2) over all capture blocks, at the centre of
+    every grid cell within the first null of any pointing. Only the non-zero
+    cells are kept, as sorted cell numbers and their depths.
+    """
+    nx, ny = shape = depth_grid_shape(cell_arcmin)
+    null = np.radians(1.5 / 1.189 * 57.5 * 1.5 / freq_ghz / 60.)
+
+    cells, weights = [], []
+    for _, _, ra, dec in MIGHTEE_POINTINGS:
+        ra0, dec0 = np.radians(ra), np.radians(dec)
+        # Cells in the (RA, sin DEC) box around the first null
+        iy0, iy1 = depth_cells(0, np.degrees([max(dec0 - null, -np.pi / 2), min(dec0 + null, np.pi / 2)]), shape) // nx
+        halfwidth = np.degrees(null / max(np.cos(abs(dec0) + null), 1e-3))
+        ix = np.arange(int(np.floor((ra - halfwidth) / 360. * nx)), int(np.ceil((ra + halfwidth) / 360. * nx)) + 1)
+        iy = np.arange(iy0, iy1 + 1)
+        cra = np.radians((ix + 0.5) * 360. / nx)
+        cdec = np.arcsin((iy + 0.5) / ny * 2 - 1)
+
+        cossep = (np.sin(cdec)[:, None] * np.sin(dec0)
+                  + np.cos(cdec)[:, None] * np.cos(dec0) * np.cos(cra - ra0)[None, :])
+        sep = np.degrees(np.arccos(np.clip(cossep, -1, 1))) * 60
+        beam = meerkat_lband_beam(sep, freq_ghz)
+        keep = beam > 0
+        cell_id = iy[:, None] * nx + (ix % nx)[None, :]
+        cells.append(cell_id[keep])
+        weights.append(beam[keep]**2)
+
+    cells, inverse = np.unique(np.concatenate(cells), return_inverse=True)
+    depth = np.sqrt(np.bincount(inverse, weights=np.concatenate(weights))).astype(np.float32)
+    return cells, depth
+
+
+def load_depth_map(freq_ghz=1.284, cell_arcmin=1.0):
+    """
+    Load the depth map from the cache, building and saving it on first use.
+    """
+    fname = depth_map_name(freq_ghz, cell_arcmin)
+    if os.path.exists(fname):
+        with np.load(fname) as cache:
+            return cache["cells"], cache["depth"]
+
+    print(f"Building the MIGHTEE depth map, cached in {fname}", file=sys.stderr)
+    cells, depth = build_depth_map(freq_ghz, cell_arcmin)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpname = fname + f".{os.getpid()}.npz"
+    np.savez(tmpname, cells=cells, depth=depth)
+    os.replace(tmpname, fname)
+    return cells, depth
+
+
+def lookup_depth(ra_deg, dec_deg, freq_ghz=1.284, cell_arcmin=1.0, depth_map=None):
+    """
+    Relative depth at each position, normalised so that the centre of a
+    single capture block is 1. Zero outside the coverage.
+    """
+    cells, depth = depth_map if depth_map is not None else load_depth_map(freq_ghz, cell_arcmin)
+    query = depth_cells(np.asarray(ra_deg, dtype=float), np.asarray(dec_deg, dtype=float),
+                        depth_grid_shape(cell_arcmin))
+    idx = np.minimum(np.searchsorted(cells, query), len(cells) - 1)
+    return np.where(cells[idx] == query, depth[idx], 0.)
+
+
+def mightee_coverage(ra_str, dec_str, freq_ghz=1.284, cell_arcmin=1.0):
+    input_coord = parse_coordinate(ra_str, dec_str)
+    depth = lookup_depth(input_coord.ra.deg, input_coord.dec.deg, freq_ghz, cell_arcmin)
+
+    print(f"Input: RA={input_coord.ra.deg:.5f} deg, DEC={input_coord.dec.deg:.5f} deg")
+    print(f"Relative depth (single capture block centre = 1) : {float(depth):.3f}")
+    if depth > 0:
+        print(f"Relative noise : {1 / float(depth):.3f}")
+
+
+def mightee_batch_coverage(fname, ra_col=None, dec_col=None, output=None, freq_ghz=1.284, cell_arcmin=1.0):
+    """
+    Write the relative depth of every position of a table as CSV.
+    """
+    ra, dec = read_positions(fname, ra_col, dec_col)
+    depth_map = load_depth_map(freq_ghz, cell_arcmin)
+
+    out = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["source", "ra", "dec", "depth"])
+        for start in range(0, len(ra), BATCH_CHUNK):
+            stop = min(start + BATCH_CHUNK, len(ra))
+            depth = lookup_depth(ra[start:stop], dec[start:stop], freq_ghz, cell_arcmin, depth_map)
+            writer.writerows((jj, f"{ra[jj]:.6f}", f"{dec[jj]:.6f}", f"{dd:.4f}")
+                             for jj, dd in zip(range(start, stop), depth))
+    finally:
+        if output:
+            out.close()
+
+
+def mightee_batch(fname, top=3, radius=None, ra_col=None, dec_col=None, output=None):
+    """
+    Match every position of a table against MIGHTEE_POINTINGS.
+
+    Returns the `top` closest pointings of each source, or all the pointings
+    within `radius` arcmin if it is given. The rows are written as CSV as
+    each chunk of sources is matched.
+    """
+    ra, dec = read_positions(fname, ra_col, dec_col)
+    tree = pointing_tree()
+    top = min(top, len(MIGHTEE_POINTINGS))
+
+    out = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["source", "ra", "dec", "capture_block", "field", "pointing_ra", "pointing_dec", "sep_arcmin"])
+        for start in range(0, len(ra), BATCH_CHUNK):
+            vecs = unit_vectors(ra[start:start + BATCH_CHUNK], dec[start:start + BATCH_CHUNK])
+            if radius is None:
+                chords, indices = tree.query(vecs, k=list(range(1, top + 1)))
+                matches = [zip(c, i) for c, i in zip(chords, indices)]
+            else:
+                # Search radius as the chord between unit vectors
+                chord = 2 * np.sin(np.radians(radius / 60.) / 2)
+                matches = []
+                for vec, idx in zip(vecs, tree.query_ball_point(vecs, chord)):
+                    chords = np.linalg.norm(tree.data[idx] - vec, axis=1)
+                    order = np.argsort(chords)
+                    matches.append(zip(chords[order], np.asarray(idx)[order]))
+
+            rows = []
+            for jj, match in enumerate(matches, start):
+                for chord, idx in match:
+                    cb, name, pra, pdec = MIGHTEE_POINTINGS[idx]
+                    sep = np.degrees(2 * np.arcsin(min(chord / 2, 1.))) * 60
+                    rows.append((jj, f"{ra[jj]:.6f}", f"{dec[jj]:.6f}", cb, name, pra, pdec, f"{sep:.4f}"))
+            writer.writerows(rows)
+    finally:
+        if output:
+            out.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Find closest MIGHTEE pointings to a given coordinate.",
         epilog='Examples:\n'
                '  %(prog)s 150.12 2.21\n'
-               '  %(prog)s "10h00m28.6s" "+02d12m21.0s"\n',
+               '  %(prog)s "10h00m28.6s" "+02d12m21.0s"\n'
+               '  %(prog)s --batch sources.csv --radius 30 -o matches.csv\n'
+               '  %(prog)s --coverage --batch sources.csv -o depth.csv\n',
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser.add_argument("ra", help="RA in decimal degrees or HMS (e.g. 150.12 or 10h00m28.6s)")
-    parser.add_argument("dec", help="DEC in decimal degrees or DMS (e.g. 2.21 or +02d12m21.0s)")
+    parser.add_argument("ra", nargs="?", help="RA in decimal degrees or HMS (e.g. 150.12 or 10h00m28.6s)")
+    parser.add_argument("dec", nargs="?", help="DEC in decimal degrees or DMS (e.g. 2.21 or +02d12m21.0s)")
     parser.add_argument("-n", "--top", type=int, default=3, help="Number of closest matches (default: 3)")
+    parser.add_argument("--batch", metavar="TABLE",
+                        help="CSV or FITS table of positions to match, one row per source, "
+                             "in decimal degrees or HMS/DMS like RA DEC")
+    parser.add_argument("--radius", type=float, default=None,
+                        help="Batch mode: return all pointings within this radius in arcmin "
+                             "instead of the --top closest")
+    parser.add_argument("--ra-col", default=None, help="Batch mode: RA column name (default: ra)")
+    parser.add_argument("--dec-col", default=None, help="Batch mode: DEC column name (default: dec)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Batch mode: output CSV (default: standard output)")
+    parser.add_argument("--coverage", action="store_true",
+                        help="Return the primary-beam weighted relative depth summed over all "
+                             "capture blocks, instead of the closest pointings")
+    parser.add_argument("--freq", type=float, default=1.284,
+                        help="Coverage mode: frequency in GHz for the beam model (default: 1.284)")
+    parser.add_argument("--cell", type=float, default=1.0,
+                        help="Coverage mode: depth map cell size in arcmin (default: 1.0)")
     args = parser.parse_args()
-    mightee_search(args.ra, args.dec, args.top)
+
+    if args.coverage and args.batch:
+        mightee_batch_coverage(args.batch, args.ra_col, args.dec_col, args.output, args.freq, args.cell)
+    elif args.coverage and args.ra is not None and args.dec is not None:
+        mightee_coverage(args.ra, args.dec, args.freq, args.cell)
+    elif args.batch:
+        mightee_batch(args.batch, args.top, args.radius, args.ra_col, args.dec_col, args.output)
+    elif args.ra is None or args.dec is None:
+        parser.error("give an RA and DEC, or a table with --batch")
+    else:
+        mightee_search(args.ra, args.dec, args.top)
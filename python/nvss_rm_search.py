@@ -1,18 +1,222 @@
 #!/usr/bin/env python3
 
 import click
+import csv
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import urllib.request
 import pandas as pd
 import numpy as np
-from astropy.coordinates import SkyCoord, match_coordinates_sky
+from astropy.coordinates import SkyCoord
 import astropy.units as u
 
+from catalog_utils import CACHE_DIR, parse_positions, read_fields, unit_vectors
+
+NVSS_RM_URL = "https://cdsarc.cds.unistra.fr/ftp/J/ApJ/702/1230/catalog.dat.gz"
+# Version of the catalog cache (see catalog_utils), for CACHE_DTYPE and the parsing
+CACHE_VERSION = 1
+CACHE_DTYPE = np.dtype([
+    ('ra', 'f8'), ('dec', 'f8'), ('xyz', 'f8', 3),
+    ('int_flux', 'f4'), ('int_flux_err', 'f4'),
+    ('peak_pol', 'f4'), ('peak_pol_err', 'f4'),
+    ('frac_pol', 'f4'), ('frac_pol_err', 'f4'),
+    ('rm', 'f4'), ('rm_err', 'f4'),
+])
+# Whitespace separated columns of catalog.dat holding each value and its error
+# (the column in between is the '+/-')
+VALUE_COLUMNS = {'int_flux': (12, 14), 'peak_pol': (15, 17), 'frac_pol': (18, 20), 'rm': (21, 23)}
+# Number of query positions matched and written at a time in batch mode
+BATCH_CHUNK = 100000
+
+
+def download_catalog(nvss_cat):
+    print("Downloading NVSS RM catalog...")
+    with urllib.request.urlopen(NVSS_RM_URL) as response, open(nvss_cat, 'wb') as fptr:
+        shutil.copyfileobj(gzip.GzipFile(fileobj=response), fptr)
+
+
+def cache_names(nvss_cat):
+    key = hashlib.sha1(os.path.abspath(nvss_cat).encode()).hexdigest()[:16]
+    base = os.path.join(CACHE_DIR, f"nvss_rm_{key}")
+    return base + ".npy", base + ".json", base + ".kdtree.pickle"
+
+
+def source_stat(nvss_cat):
+    stat = os.stat(nvss_cat)
+    return {"path": os.path.abspath(nvss_cat), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "version": CACHE_VERSION}
+
+
+def parse_catalog(nvss_cat):
+    """
+    Parse catalog.dat into a structured array of CACHE_DTYPE, with the
+    positions in degrees and as unit vectors.
+    """
+
+    df = pd.read_csv(nvss_cat, sep=r'\s+', header=None, dtype=str)
+
+    cat = np.zeros(len(df), dtype=CACHE_DTYPE)
+    cat['ra'] = 15 * (df[0].astype(float) + df[1].astype(float) / 60. + df[2].astype(float) / 3600.)
+    # The sign is read from the text, as -00 degrees is 0 as a number
+    sign = np.where(df[5].str.startswith('-'), -1., 1.)
+    cat['dec'] = sign * (df[5].astype(float).abs() + df[6].astype(float) / 60. + df[7].astype(float) / 3600.)
+
+    cat['xyz'] = unit_vectors(cat['ra'], cat['dec'])
+
+    for name, (val, err) in VALUE_COLUMNS.items():
+        cat[name] = pd.to_numeric(df[val], errors='coerce')
+        cat[name + '_err'] = pd.to_numeric(df[err], errors='coerce')
+
+    return cat
+
+
+def load_catalog(nvss_cat):
+    """
+    Return the catalog as a read-only memory map of the binary cache. The
+    cache is rebuilt when the size or modification time of nvss_cat no
+    longer match the ones it was built from.
+    """
+
+    npyname, metaname, _ = cache_names(nvss_cat)
+    stat = source_stat(nvss_cat)
+    try:
+        with open(metaname) as fptr:
+            if json.load(fptr) == stat:
+                return np.load(npyname, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+
+    cat = parse_catalog(nvss_cat)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpname = f"{npyname}.{os.getpid()}.npy"
+    np.save(tmpname, cat)
+    os.replace(tmpname, npyname)
+    with open(metaname + ".tmp", 'w') as fptr:
+        json.dump(stat, fptr)
+    os.replace(metaname + ".tmp", metaname)
+
+    return np.load(npyname, mmap_mode='r')
+
+
+def load_index(nvss_cat, cat):
+    """
+    Return a KD-tree over the unit vectors of the catalog. The tree is
+    pickled next to the binary cache and rebuilt whenever the cache is newer.
+    """
+    from scipy.spatial import cKDTree
+
+    npyname, _, treename = cache_names(nvss_cat)
+    if os.path.exists(treename) and os.path.getmtime(treename) >= os.path.getmtime(npyname):
+        with open(treename, 'rb') as fptr:
+            return pickle.load(fptr)
+
+    tree = cKDTree(np.asarray(cat['xyz']))
+    tmpname = f"{treename}.{os.getpid()}"
+    with open(tmpname, 'wb') as fptr:
+        pickle.dump(tree, fptr, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, treename)
+    return tree
+
+
+def chord_to_deg(chord):
+    return np.degrees(2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1)))
+
+
+def batch_search(tree, ra, dec, radius=None, nearest=None):
+    """
+    Match many positions (degrees) against the catalog through its KD-tree.
+
+    With radius (degrees, scalar or one per position) all the sources in each
+    cone are returned, with nearest the k closest sources, and with both the
+    k closest within the cone. Returns the matched pairs as flat arrays of
+    (position index, catalog index, separation in degrees), sorted by
+    position and then separation.
+    """
+
+    vecs = unit_vectors(ra, dec)
+    if nearest is not None:
+        nearest = min(nearest, tree.n)
+        upper = np.inf if radius is None else 2 * np.sin(np.radians(np.max(radius)) / 2)
+        chords, indices = tree.query(vecs, k=list(range(1, nearest + 1)), distance_upper_bound=upper)
+        query = np.repeat(np.arange(len(vecs)), nearest).reshape(chords.shape)
+        sep = chord_to_deg(np.where(np.isfinite(chords), chords, 2))
+        keep = np.isfinite(chords)
+        if radius is not None:
+            keep &= sep <= np.broadcast_to(radius, len(vecs))[:, None]
+        # query returns each row sorted by distance already
+        return query[keep], indices[keep], sep[keep]
+
+    chords = 2 * np.sin(np.radians(np.broadcast_to(radius, len(vecs))) / 2)
+    matches = tree.query_ball_point(vecs, chords)
+    query = np.repeat(np.arange(len(vecs)), [len(idx) for idx in matches])
+    index = np.fromiter((ii for idx in matches for ii in idx), dtype=int, count=len(query))
+    sep = chord_to_deg(np.linalg.norm(tree.data[index] - vecs[query], axis=1))
+    order = np.lexsort((sep, query))
+
+    return query[order], index[order], sep[order]
+
+
+def read_centres(fname, default_radius=None):
+    """
+    Read query positions, one 'ra dec [radius]' per line (whitespace or comma
+    separated, '#' starts a comment). RA/DEC are decimal degrees or
+    sexagesimal, the radius is in degrees.
+    """
+
+    rows = read_fields(fname)
+    ra, dec = parse_positions([fields[0] for fields in rows], [fields[1] for fields in rows])
+    radii = [float(fields[2]) if len(fields) > 2 else default_radius for fields in rows]
+
+    if any(rad is None for rad in radii):
+        radii = None
+    return ra, dec, radii
+
+
+def write_batch_matches(cat, tree, ra, dec, radius, nearest, output=None):
+    """
+    Write the matches of every query position as CSV, one row per pair.
+    """
+
+    columns = [name for name in CACHE_DTYPE.names if name != 'xyz']
+    # Positions to a fixed number of decimals, %g would round RA to 0.001 deg
+    fmt = ['%d', '%.6f', '%.6f', '%.5f'] + ['%.6f' if name in ('ra', 'dec') else '%.6g' for name in columns]
+
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        csv.writer(out).writerow(['query', 'query_ra', 'query_dec', 'sep_deg'] + columns)
+        for start in range(0, len(ra), BATCH_CHUNK):
+            stop = min(start + BATCH_CHUNK, len(ra))
+            rad = radius if radius is None else radius[start:stop]
+            query, index, sep = batch_search(tree, ra[start:stop], dec[start:stop], rad, nearest)
+            matches = cat[index]
+            table = np.column_stack([query + start, ra[start:stop][query], dec[start:stop][query], sep]
+                                    + [matches[name] for name in columns])
+            np.savetxt(out, table, fmt=fmt, delimiter=',')
+    finally:
+        if output:
+            out.close()
+
+
+def format_value(value, error):
+    return f"{value:.6g}+/-{error:.6g}"
+
 
 @click.command()
-@click.argument('nvss_cat', type=click.File())
-@click.argument('ra', type=str)
-@click.argument('dec', type=str)
-@click.argument('radius', type=float)
-def cone_search(nvss_cat, ra, dec, radius):
+@click.argument('nvss_cat', type=click.Path(dir_okay=False))
+@click.argument('ra', type=str, required=False)
+@click.argument('dec', type=str, required=False)
+@click.argument('radius', type=float, required=False)
+@click.option('--centres', type=click.Path(exists=True, dir_okay=False),
+              help="File of query positions, one 'ra dec [radius]' per line, matched in one pass")
+@click.option('--radius', 'batch_radius', type=float, help='Batch mode: radius in degrees for lines without one')
+@click.option('--nearest', type=int, help='Return the k nearest sources of each position (within the radius if given)')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Batch mode: output CSV (default: standard output)')
+def cone_search(nvss_cat, ra, dec, radius, centres, batch_radius, nearest, output):
     """
     Given the input NVSS RM catalog and a source RA and DEC this performs a cone search within the given RADIUS and prints
     out all the matches.
@@ -23,8 +227,28 @@ def cone_search(nvss_cat, ra, dec, radius):
 
     The RM catalog can be obtained here - https://cdsarc.cds.unistra.fr/ftp/J/ApJ/702/1230/catalog.dat.gz
     and unzipped. If it does not exist in your directory already it will be automatically downloaded (~ 2 MB).
+
+    The catalog is converted once into a binary cache in ~/.cache/astroscripts, which is rebuilt whenever the
+    catalog file changes.
+
+    With --centres, all the positions of the file are matched through a KD-tree over the catalog, which is kept
+    with the cache, and the matches are written as CSV with one row per (position, source) pair.
     """
 
+    if centres is not None:
+        if not os.path.exists(nvss_cat):
+            download_catalog(nvss_cat)
+        cat = load_catalog(nvss_cat)
+        tree = load_index(nvss_cat, cat)
+        qra, qdec, radii = read_centres(centres, batch_radius)
+        if radii is None and nearest is None:
+            raise click.UsageError('Give a radius per line, --radius or --nearest')
+        write_batch_matches(cat, tree, qra, qdec, None if radii is None else np.array(radii), nearest, output)
+        return
+
+    if ra is None or dec is None or radius is None:
+        raise click.UsageError('Give RA DEC RADIUS, or a --centres file')
+
     try:
         target_coord = SkyCoord(f'{ra} {dec}')
     except ValueError as e:
@@ -33,43 +257,25 @@ def cone_search(nvss_cat, ra, dec, radius):
 
     ## Download catalog if it doesn't exist
     if not os.path.exists(nvss_cat):
-        print("Downloading NVSS RM catalog...")
-        os.system("wget https://cdsarc.cds.unistra.fr/ftp/J/ApJ/702/1230/catalog.dat.gz")
-        os.system("gunzip catalog.dat.gz")
-        nvss_cat = "catalog.dat"
-
-    df = pd.read_csv(nvss_cat, delim_whitespace=True, header=None)
-    ra = [f"{hh}h{mm}m{ss}s" for hh, mm, ss in zip(df[0], df[1], df[2])]
-    dec = [f"{dd}d{mm}m{ss}s" for dd, mm, ss in zip(df[5], df[6], df[7])]
+        download_catalog(nvss_cat)
 
-    dfcoords = SkyCoord(ra, dec)
-    df['coords'] = dfcoords
-    df['coords'] = df['coords'].map(lambda x: x.to_string('hmsdms'))
+    cat = load_catalog(nvss_cat)
 
-    #df = df[['coords', 12, 15, 18, 21]]
-
-    sep = dfcoords.separation(target_coord)
-
-    radius = radius * u.degree
-    idx = np.where(sep <= radius)
-    df = df.iloc[idx]
+    target = target_coord.cartesian.xyz.value
+    idx = np.flatnonzero(cat['xyz'] @ target >= np.cos(np.radians(radius)))
+    matches = cat[idx]
 
+    # Only the matched rows are formatted
+    coords = SkyCoord(matches['ra'] * u.deg, matches['dec'] * u.deg)
     ndf = pd.DataFrame()
-    ndf = ndf.reset_index(drop=True)
-    ndf['coordinates'] = df['coords']
-    ndf['int_flux (mJy)'] = df[12].astype("str") + df[13].astype("str") + df[14].astype("str")
-    ndf['peak_pol (mJy)'] = df[15].astype("str") + df[16].astype("str") + df[17].astype("str")
-    ndf['frac_pol (mJy)'] = df[18].astype("str") + df[19].astype("str") + df[20].astype("str")
-    ndf['RM'] = df[21].astype("str") + df[22].astype("str") + df[23].astype("str")
+    ndf['coordinates'] = coords.to_string('hmsdms')
+    ndf['int_flux (mJy)'] = [format_value(*row) for row in zip(matches['int_flux'], matches['int_flux_err'])]
+    ndf['peak_pol (mJy)'] = [format_value(*row) for row in zip(matches['peak_pol'], matches['peak_pol_err'])]
+    ndf['frac_pol (%)'] = [format_value(*row) for row in zip(matches['frac_pol'], matches['frac_pol_err'])]
+    ndf['RM'] = [format_value(*row) for row in zip(matches['rm'], matches['rm_err'])]
 
     print(ndf.to_string(index=False))
 
-    #print("Coordinates         Integrated Flux (mJy)        Peak Pol flux (mJy)            % Pol        RM")
-    #for row in df.iterrows():
-    #    print(row)
-    #    print(row[24].to_string('hmsdms'), row[12], row[15], row[18], row[21])
-
-
 
 if __name__ == '__main__':
     cone_search()
@@ -1,62 +1,351 @@
 #! /usr/bin/env python
 
+import re
 import click
+import numpy as np
+
+# Telescope sites : longitude (east positive) and latitude in degrees,
+# height in metres. Add new sites here, the keys are matched in lower case.
+SITES = {
+    'ugmrt': {'name': 'uGMRT', 'lon': 74 + 2 / 60. + 59 / 3600., 'lat': 19 + 5 / 60. + 47 / 3600., 'height': 0.},
+    'meerkat': {'name': 'MeerKAT', 'lon': 21 + 26 / 60. + 38 / 3600., 'lat': -(30 + 42 / 60. + 39.8 / 3600.),
+                'height': 1086.6},
+    'alma': {'name': 'ALMA', 'lon': -(67 + 45 / 60. + 12 / 3600.), 'lat': -(23 + 1 / 60. + 9 / 3600.), 'height': 0.},
+}
+SITES['gmrt'] = SITES['ugmrt']
+
+MJD_J2000 = 51544.5
+EPOCH_J2000 = np.datetime64('2000-01-01T12:00:00', 'ns')
+# TT - UTC in seconds since 2017, only used for the slowly varying terms
+TT_MINUS_UTC = 69.184
+# Rows of a --pairs file processed at a time
+PAIRS_CHUNK = 1000000
+
+
+def get_site(name):
+    try:
+        return SITES[name.lower()]
+    except KeyError:
+        raise NotImplementedError(f"Unknown telescope name {name}, known sites : {', '.join(sorted(SITES))}")
+
+
+def to_mjd(times):
+    """
+    MJD (UTC) of ISO time strings or datetime64 values.
+    """
+
+    times = np.asarray(times, dtype='datetime64[ns]')
+    return MJD_J2000 + (times - EPOCH_J2000) / np.timedelta64(1, 'D')
+
+
+def from_mjd(mjd):
+    return EPOCH_J2000 + np.round((np.asarray(mjd) - MJD_J2000) * 86400e9).astype('timedelta64[ns]')
+
+
+def time_grid(beg_time, end_time, cadence):
+    """
+    MJDs from beg_time to end_time (inclusive) every cadence minutes.
+    """
+
+    beg_mjd, end_mjd = to_mjd([beg_time, end_time])
+    if end_mjd < beg_mjd:
+        raise click.BadParameter("The end time is before the beginning time")
+    step = cadence / 1440.
+    nstep = int(np.ceil((end_mjd - beg_mjd) / step - 1e-9))
+
+    return np.append(beg_mjd + np.arange(nstep) * step, end_mjd)
+
+
+def local_sidereal_time(mjd, lon, dut1=0.):
+    """
+    Local mean sidereal time in degrees at the UTC MJDs, for the east
+    longitude lon in degrees, from the IAU 2006 Earth rotation angle and
+    precession terms. The mean time is the one astroplan's parallactic
+    angle uses.
+
+    No IERS table is read : UT1 is taken as UTC + dut1 (seconds). As
+    |UT1 - UTC| < 0.9 s, with dut1 = 0 the sidereal time is within 0.004 deg
+    (1 s of time) of astropy's, and within 0.0001 deg with the right dut1.
+    """
+
+    days = np.asarray(mjd, dtype=float) - MJD_J2000
+    du = days + dut1 / 86400.
+    era = 360. * np.mod(0.7790572732640 + 0.00273781191135448 * du + np.mod(du, 1.), 1.)
+
+    cent = (days + TT_MINUS_UTC / 86400.) / 36525.
+    prec = (0.014506 + 4612.156534 * cent + 1.3915817 * cent**2 - 0.00000044 * cent**3
+            - 0.000029956 * cent**4) / 3600.
+
+    return np.mod(era + prec + lon, 360.)
+
+
+def parallactic_angle(ha, dec, lat):
+    """
+    Parallactic angle and elevation in degrees for the hour angles and
+    declinations (broadcast together) at latitude lat, all in degrees, with
+    the same formula as astroplan's Observer.parallactic_angle.
+    """
+
+    ha = np.radians(ha)
+    dec = np.radians(dec)
+    lat = np.radians(lat)
+
+    parang = np.arctan2(np.sin(ha), np.tan(lat) * np.cos(dec) - np.sin(dec) * np.cos(ha))
+    sin_el = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(ha)
+
+    return np.degrees(parang), np.degrees(np.arcsin(np.clip(sin_el, -1, 1)))
+
+
+def hour_angle(lst, ra):
+    return np.mod(lst - ra + 180., 360.) - 180.
+
+
+def parang_tracks(lst, ra, dec, lat):
+    """
+    Parallactic angle, hour angle and elevation (degrees) of every target
+    (ra, dec arrays) at every local sidereal time, as (ntarget, ntime)
+    arrays.
+    """
+
+    ha = hour_angle(np.asarray(lst)[None, :], np.asarray(ra)[:, None])
+    parang, elev = parallactic_angle(ha, np.asarray(dec)[:, None], lat)
+
+    return parang, ha, elev
+
+
+def track_windows(mask):
+    """
+    (start, stop) sample indices (stop inclusive) of the runs of True in mask.
+    """
+
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], mask.astype(int), [0]])))
+    return list(zip(edges[::2], edges[1::2] - 1))
+
+
+def track_summary(mjd, parang, ha, elev, min_elev):
+    """
+    Summarise the track of one target sampled at mjd : the transit MJD (hour
+    angle going through zero, interpolated between samples), the windows
+    above min_elev, and the parallactic angle range covered in each, from
+    the unwrapped track so that wraps through +-180 degrees at transit are
+    followed.
+    """
+
+    crossing = np.flatnonzero((ha[:-1] < 0) & (ha[1:] >= 0))
+    transit = None
+    if len(crossing):
+        ii = crossing[0]
+        frac = -ha[ii] / (ha[ii + 1] - ha[ii])
+        transit = mjd[ii] + frac * (mjd[ii + 1] - mjd[ii])
+
+    unwrapped = np.degrees(np.unwrap(np.radians(parang)))
+    windows = []
+    for start, stop in track_windows(elev >= min_elev):
+        track = unwrapped[start:stop + 1]
+        windows.append((mjd[start], mjd[stop], parang[start], parang[stop], track[-1] - track[0],
+                        track.max() - track.min()))
+
+    return transit, windows
+
+
+def parse_angle(text, hours=False):
+    """
+    Angle in degrees from decimal degrees, or sexagesimal text such as
+    12h30m00.0s, -30d00m00s or 12:30:00. Sexagesimal RA (hours=True) is in
+    hours, decimal RA in degrees.
+    """
+
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    fields = [ff for ff in re.split(r'[hdms:\s]+', text.lstrip('+-')) if ff]
+    if not 1 <= len(fields) <= 3:
+        raise click.BadParameter(f"Cannot parse the angle {text}")
+    try:
+        value = sum(float(ff) / 60**ii for ii, ff in enumerate(fields))
+    except ValueError:
+        raise click.BadParameter(f"Cannot parse the angle {text}")
+    if text.startswith('-'):
+        value = -value
+
+    return value * 15 if hours else value
+
+
+def read_targets(fname):
+    """
+    Read a target list, one 'name ra dec' per line, with the coordinates in
+    HMS DMS or decimal degrees. '#' starts a comment.
+    """
+
+    names, ras, decs = [], [], []
+    with open(fname) as fptr:
+        for line in fptr:
+            fields = line.split('#')[0].replace(',', ' ').split()
+            if not fields:
+                continue
+            names.append(fields[0])
+            ras.append(parse_angle(fields[1], hours=True))
+            decs.append(parse_angle(fields[2]))
+
+    return names, np.array(ras), np.array(decs)
+
+
+def format_time(mjd, timezone):
+    time = (from_mjd(mjd) + np.timedelta64(500, 'ms')).astype('datetime64[s]')
+    if timezone in ('Etc/GMT0', 'UTC', 'GMT'):
+        return str(time).replace('T', ' ') + ' UTC'
+
+    from datetime import timezone as tz
+    from zoneinfo import ZoneInfo
+    return time.item().replace(tzinfo=tz.utc).astimezone(ZoneInfo(timezone)).strftime('%Y-%m-%d %H:%M:%S %Z')
+
+
+def compare_astroplan(mjd, ra, dec, site, parang, dut1):
+    """
+    Compare the sidereal times and parallactic angles against astroplan,
+    which needs astropy's IERS tables (and may try to download them).
+    Only the samples above the horizon and more than 5 degrees from the
+    zenith are compared, as near the zenith the parallactic angle changes
+    too fast with the hour angle to be compared.
+    """
+
+    try:
+        from astroplan import Observer
+    except ImportError:
+        raise click.ClickException("--validate needs astroplan")
+    from astropy.coordinates import EarthLocation, SkyCoord
+    from astropy.time import Time
+    import astropy.units as u
+
+    observer = Observer(EarthLocation(lon=site['lon'] * u.deg, lat=site['lat'] * u.deg, height=site['height'] * u.m))
+    times = Time(mjd, format='mjd', scale='utc')
+    lst = local_sidereal_time(mjd, site['lon'], dut1)
+    dlst = np.abs(hour_angle(observer.local_sidereal_time(times, kind='mean').deg, lst)).max()
+
+    dparang = 0.
+    for ii in range(len(ra)):
+        ref = observer.parallactic_angle(times, SkyCoord(ra[ii] * u.deg, dec[ii] * u.deg)).deg
+        _, elev = parallactic_angle(hour_angle(lst, ra[ii]), dec[ii], site['lat'])
+        diff = np.abs(hour_angle(parang[ii], ref))[(elev > 0) & (elev < 85)]
+        if len(diff):
+            dparang = max(dparang, diff.max())
+
+    print(f"\nLargest difference to astroplan : LST {dlst:.6f} deg, parallactic angle {dparang:.6f} deg")
+
+
+def process_pairs(fname, output, site, dut1, chunk=PAIRS_CHUNK):
+    """
+    Parallactic angle of every (time, ra, dec) row of a CSV file with those
+    columns, times as ISO strings or MJD (UTC) and coordinates in degrees.
+    The file is read and written chunk rows at a time.
+    """
+
+    import pandas as pd
+
+    nrows = 0
+    with open(output, 'w') as out:
+        out.write("mjd,ra,dec,ha,parang,elev\n")
+        for df in pd.read_csv(fname, usecols=['time', 'ra', 'dec'], chunksize=chunk):
+            if pd.api.types.is_numeric_dtype(df['time']):
+                mjd = df['time'].to_numpy(dtype=float)
+            else:
+                mjd = to_mjd(pd.to_datetime(df['time']).to_numpy(dtype='datetime64[ns]'))
+            ra = df['ra'].to_numpy(dtype=float)
+            dec = df['dec'].to_numpy(dtype=float)
+            ha = hour_angle(local_sidereal_time(mjd, site['lon'], dut1), ra)
+            parang, elev = parallactic_angle(ha, dec, site['lat'])
+            np.savetxt(out, np.column_stack([mjd, ra, dec, ha, parang, elev]),
+                       fmt=['%.8f', '%.6f', '%.6f', '%.5f', '%.5f', '%.5f'], delimiter=',')
+            nrows += len(df)
+
+    print(f"Wrote the parallactic angles of {nrows} rows to {output}")
+
 
 @click.command()
 @click.argument('name', type=str)
-@click.argument('beg_time', type=str)
-@click.argument('end_time', type=str)
-@click.argument('coord_ra', type=str)
-@click.argument('coord_dec', type=str)
+@click.argument('beg_time', type=str, required=False)
+@click.argument('end_time', type=str, required=False)
+@click.argument('coord_ra', type=str, required=False)
+@click.argument('coord_dec', type=str, required=False)
 @click.option('--timezone', default='Etc/GMT0',
-              help='Time zone (default: Etc/GMT0)')
-def print_parangs(name, beg_time, end_time, coord_ra, coord_dec, timezone):
+              help='Time zone the times are printed in (default: Etc/GMT0)')
+@click.option('--targets', type=click.Path(exists=True, dir_okay=False),
+              help="File of targets, one 'name ra dec' per line, all computed at once")
+@click.option('--cadence', type=float, default=1., show_default=True,
+              help='Sampling of the parallactic angle track in minutes')
+@click.option('--min-elev', type=float, default=15., show_default=True,
+              help='Elevation limit in degrees for the observable windows')
+@click.option('--pairs', type=click.Path(exists=True, dir_okay=False),
+              help='CSV file with time, ra, dec columns, each row computed on its own (batch mode)')
+@click.option('-o', '--output', default='parang.csv', show_default=True, help='Output CSV of --pairs')
+@click.option('--dut1', type=float, default=0., show_default=True,
+              help='UT1 - UTC in seconds, if known')
+@click.option('--validate', is_flag=True, help='Compare the results against astroplan (needs IERS tables)')
+def print_parangs(name, beg_time, end_time, coord_ra, coord_dec, timezone, targets, cadence, min_elev, pairs,
+                  output, dut1, validate):
     """
     Prints the parallactic angle range given the start and end observing
     times (in UCT/GMT), the telescope name and the celestial target
     coordinates.
 
-    Currently accepted telescope names : uGMRT or MeerKAT (case insensitive)
+    Currently accepted telescope names : uGMRT, MeerKAT or ALMA (case insensitive)
 
     The beg time and end time should be in the format '2020-01-01T00:00:00'
 
     The target coordinates must be in HMS DMS (i.e., 00h00m00s +00d00m00s)
-    """
 
-    from astroplan import Observer
-    import astropy.units as u
-    from astropy.coordinates import SkyCoord
-    from astropy.time import Time
+    The whole track is sampled every --cadence minutes, so the parallactic
+    angle coverage follows wraps through transit. With --targets, all the
+    targets of the file are computed in one go and summarised with their
+    transit time and the windows above --min-elev. With --pairs, the
+    parallactic angle of every row of the file is written to --output.
 
-    import numpy as np
-
-    if name.lower() == 'ugmrt' or name.lower() == 'gmrt':
-        obs = Observer(longitude = '74d02m59s' , latitude = '19d05m47s' ,
-                       elevation = 0*u.m, name = 'uGMRT', timezone=timezone)
-    elif name.lower() == 'meerkat':
-        obs = Observer(longitude = '21d26m38s' , latitude='-30d42m39.8s',
-                       elevation = 1086.6*u.m , name = 'MeerKAT',
-                       timezone=timezone)
-    elif name.lower() == 'alma':
-        obs = Observer(longitude = '67d45m12s' , latitude='-23d01m09s',
-                       elevation = 0*u.m , name = 'ALMA',
-                       timezone=timezone)
-    else:
-        raise NotImplementedError("Unknown telescope name")
+    The sidereal time is computed offline, without IERS tables, and is
+    within 0.004 deg of astropy's (0.0001 deg given --dut1), so the
+    parallactic angles agree with astroplan to 0.04 deg below 85 deg
+    elevation (0.001 deg given --dut1). --validate checks this.
+    """
 
+    site = get_site(name)
 
-    coord = SkyCoord(coord_ra, coord_dec)
+    if pairs is not None:
+        process_pairs(pairs, output, site, dut1)
+        return
+
+    if beg_time is None or end_time is None:
+        raise click.UsageError('Give BEG_TIME and END_TIME, or a --pairs file')
+    if targets is not None:
+        names, ra, dec = read_targets(targets)
+    elif coord_ra is not None and coord_dec is not None:
+        names = [f"{coord_ra} {coord_dec}"]
+        ra, dec = np.array([parse_angle(coord_ra, hours=True)]), np.array([parse_angle(coord_dec)])
+    else:
+        raise click.UsageError('Give COORD_RA COORD_DEC, or a --targets file')
 
-    beg_time = Time(beg_time)
-    end_time = Time(end_time)
+    mjd = time_grid(beg_time, end_time, cadence)
+    lst = local_sidereal_time(mjd, site['lon'], dut1)
+    parang, ha, elev = parang_tracks(lst, ra, dec, site['lat'])
 
-    parang_beg = np.rad2deg(obs.parallactic_angle(beg_time, coord))
-    parang_end = np.rad2deg(obs.parallactic_angle(end_time, coord))
+    for ii, target in enumerate(names):
+        transit, windows = track_summary(mjd, parang[ii], ha[ii], elev[ii], min_elev)
+        unwrapped = np.degrees(np.unwrap(np.radians(parang[ii])))
 
-    print("Beginning parallactic angle {:.3f}".format(parang_beg))
-    print("Ending parallactic angle {:.3f}".format(parang_end.deg))
+        print(f"\n{target} ({site['name']})")
+        print("Beginning parallactic angle {:.3f}".format(parang[ii, 0]))
+        print("Ending parallactic angle {:.3f}".format(parang[ii, -1]))
+        print("Parang delta {:.3f}".format(unwrapped[-1] - unwrapped[0]))
+        print("Transit : {}".format(format_time(transit, timezone) if transit is not None else 'not in the track'))
+        if not windows:
+            print(f"Never above {min_elev:.1f} deg elevation")
+        for wbeg, wend, pbeg, pend, delta, coverage in windows:
+            print(f"Above {min_elev:.1f} deg : {format_time(wbeg, timezone)} - {format_time(wend, timezone)}, "
+                  f"parang {pbeg:.3f} -> {pend:.3f}, delta {delta:.3f}, coverage {coverage:.3f}")
 
-    print("Parang delta {:.3f}".format(parang_end - parang_beg))
+    if validate:
+        compare_astroplan(mjd, ra, dec, site, parang, dut1)
 
 if __name__ == '__main__':
     print_parangs()
@@ -2,72 +2,172 @@
 
 import argparse
 import os
-import shutil
 import numpy as np
-import matplotlib.pyplot as plt
 
-from matplotlib.colors import SymLogNorm
+from collections import deque
+from multiprocessing.pool import Pool
+
+try:
+    from scipy import fft
+except ImportError:
+    from numpy import fft
+
+from image_io import create_like, open_image, plane_indices, remove_image
+
+def signed_freq(idx, n):
+    return np.where(idx > n // 2, idx - n, idx)
+
+
+def half_plane(fx, fy, nx, ny):
+    """
+    Map frequencies (fx, fy) of the full FFT plane to their pixel in the
+    rfft2 half plane, which holds fy in [0, ny // 2] and the rest through
+    the Hermitian symmetry F(-fx, -fy) = conj(F(fx, fy)).
+    """
+
+    fx = np.mod(fx, nx)
+    fy = np.mod(fy, ny)
+    flip = fy > ny // 2
+    fx = np.where(flip, np.mod(-fx, nx), fx)
+    fy = np.where(flip, ny - fy, fy)
+    return fx, fy
+
+
+def notch(fftdat, fx, fy, width, shape):
+    """
+    Zero the (2 * width + 1)^2 box around the frequency (fx, fy) in the
+    half plane FFT, which also removes its Hermitian partner. In the fy = 0
+    and Nyquist columns both halves are stored, so the partner pixels there
+    are zeroed explicitly.
+    """
+
+    nx, ny = shape
+    dx, dy = np.meshgrid(np.arange(-width, width + 1), np.arange(-width, width + 1), indexing='ij')
+    hx, hy = half_plane(fx + dx.ravel(), fy + dy.ravel(), nx, ny)
+    fftdat[hx, hy] = 0
+    edge = (hy == 0) | (2 * hy == ny)
+    fftdat[np.mod(-hx[edge], nx), hy[edge]] = 0
+
+
+def find_peaks(mag, npeaks, separation, shape):
+    """
+    The npeaks brightest pixels of the half plane FFT magnitude that are
+    more than separation pixels apart, counting their Hermitian partners
+    too, as signed (fx, fy) frequencies. The candidates are taken with a
+    single partition of the magnitudes, and more only if suppression used
+    them all up.
+    """
+
+    nx, ny = shape
+    ncand = min(mag.size, npeaks * (2 * separation + 1)**2 * 2)
+    while True:
+        cand = np.argpartition(mag, mag.size - ncand, axis=None)[mag.size - ncand:]
+        cand = cand[np.argsort(mag.ravel()[cand])[::-1]]
+        cx, cy = np.unravel_index(cand, mag.shape)
+        cx = signed_freq(cx, nx)
+
+        peaks = []
+        for fx, fy in zip(cx, cy):
+            if len(peaks) == npeaks:
+                break
+            near = False
+            for px, py in peaks:
+                for sx, sy in ((px, py), (-px, -py)):
+                    ddx = signed_freq(np.mod(fx - sx, nx), nx)
+                    ddy = signed_freq(np.mod(fy - sy, ny), ny)
+                    near |= max(abs(ddx), abs(ddy)) <= separation
+            if not near:
+                peaks.append((int(fx), int(fy)))
+
+        if len(peaks) == npeaks or ncand == mag.size:
+            return peaks
+        ncand = min(mag.size, 4 * ncand)
+
+
+def remove_peaks(dat, npeaks, width=0):
+    """
+    Notch the npeaks brightest peaks of the FFT of a plane, and their
+    Hermitian partners, with a box of (2 * width + 1)^2 pixels. The zero
+    frequency is never removed. Blanked (NaN) pixels are zero in the FFT
+    and blanked again in the output.
+
+    The FFT is a float32 real-input one, which holds half of the plane, and
+    it is left unshifted as the shifts only change the phases.
+
+    Returns the cleaned plane and the peak frequencies.
+    """
+
+    dat = np.asarray(dat, dtype=np.float32)
+    blank = ~np.isfinite(dat)
+    if blank.all():
+        return dat, []
+    if blank.any():
+        dat = np.where(blank, np.float32(0), dat)
+
+    fftdat = fft.rfft2(dat)
+    mag = np.abs(fftdat)
+    mag[0, 0] = 0
+    peak_locs = find_peaks(mag, npeaks, max(width, 1), dat.shape)
+    del mag
+
+    dc = fftdat[0, 0]
+    for fx, fy in peak_locs:
+        notch(fftdat, fx, fy, width, dat.shape)
+    fftdat[0, 0] = dc
+
+    ifftdat = fft.irfft2(fftdat, s=dat.shape)
+    ifftdat[blank] = np.nan
+
+    return ifftdat, peak_locs
+
+
+def _clean_plane(args):
+    """
+    Worker : clean one plane, returns its index along with the result so
+    that it can be written back in place.
+    """
+
+    index, dat, npeaks, width = args
+    cleaned, peak_locs = remove_peaks(dat, npeaks, width)
+    return index, cleaned, peak_locs
+
+
+def plot_plane(dat, ifftdat):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import SymLogNorm
+
+    fig, ax = plt.subplots(2, 1, figsize=(10, 6))
+    ax[0].imshow(dat, cmap='viridis', origin='lower', norm=SymLogNorm(linthresh=1e-5, vmin=-0.01, vmax=0.1))
+    ax[1].imshow(ifftdat, cmap='viridis', origin='lower', norm=SymLogNorm(linthresh=1e-5, vmin=-0.01, vmax=0.1))
+    plt.tight_layout()
+
+    fig, ax = plt.subplots(1, 1, figsize=(10, 6))
+    fftdat = fft.rfft2(np.nan_to_num(ifftdat))
+    ax.imshow(np.abs(np.fft.fftshift(fftdat, axes=0)), cmap='viridis', origin='lower')
+    ax.set_title('FFT Magnitude')
+    plt.show()
 
-from casatools import image 
-ia = image()
 
 def kill_ripple():
-    parser = argparse.ArgumentParser(description='Kill ripple in a CASA image.')
-    parser.add_argument('image', type=str, help='Input CASA image file')
+    parser = argparse.ArgumentParser(description='Kill ripple in every channel and Stokes plane of a CASA or FITS image.')
+    parser.add_argument('image', type=str, help='Input CASA image or FITS file')
     parser.add_argument('--npeaks', type=int, default=1, help='Number of peaks in the FFT to remove (default: 1)')
-    parser.add_argument('--verbose', action='store_true', help='Enable verbose output, and diagnostic plots')
+    parser.add_argument('--notch-width', type=int, default=0,
+                        help='Half width in pixels of the box zeroed around each FFT peak (default: 0, the peak pixel only)')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose output, and diagnostic plots of the first plane')
     parser.add_argument('--outfile', type=str, default=None, help='Output file name for the modified image (default: None)')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite the output file if it exists')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes taking the FFTs (default: 1)')
+    parser.add_argument('--inflight', type=int, default=None,
+                        help='Most planes being processed at once, which bounds the memory use (default: 2 x workers)')
 
     args = parser.parse_args()
 
-    if args.verbose:
-        print(f"Reading data")
-    ia.open(args.image)
-    dat = ia.getchunk()[:,:,0,0]
-    ia.close()
-
-    if args.verbose:
-        print(f"Taking fft")
-    fftdat = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(dat)))
-
-    cx, cy = np.array(fftdat.shape) // 2
-
-    for nn in range(args.npeaks):
-        peak_loc = np.unravel_index(np.argmax(np.abs(fftdat)), fftdat.shape)
-        delta_x = peak_loc[0] - cx
-        delta_y = peak_loc[1] - cy
-
-        # Greab the peak and its hermitian conjugate counterpart
-        peak_locs = [(cx + delta_x, cy + delta_y), (cx - delta_x, cy - delta_y)]
-
-        if args.verbose:
-            print(f"Peak location: {peak_locs}")
-
-        for loc in peak_locs:
-            fftdat[loc] = 0.0
-
-    ifftdat = np.fft.fftshift(np.fft.ifft2(np.fft.fftshift(fftdat))).real
-
-    if args.verbose:
-        print(f"Plotting")
-        fig, ax = plt.subplots(2, 1, figsize=(10, 6))
-        ax[0].imshow(dat, cmap='viridis', origin='lower', norm=SymLogNorm(linthresh=1e-5, vmin=-0.01, vmax=0.1))
-        ax[1].imshow(ifftdat, cmap='viridis', origin='lower', norm=SymLogNorm(linthresh=1e-5, vmin=-0.01, vmax=0.1))
-        plt.tight_layout()
-
-        fig, ax = plt.subplots(1, 1, figsize=(10, 6))
-        ax.imshow(np.abs(fftdat), cmap='viridis', origin='lower)
-        ax.set_title('FFT Magnitude')
-        plt.show()
-
     if args.outfile:
         outname = args.outfile
     else:
-        outname = args.image.replace('.image', '_ripple_killed.image')
-
-    if args.verbose:
-        print(f"Writing output to {outname}")
+        root, ext = os.path.splitext(args.image.rstrip('/'))
+        outname = root + '_ripple_killed' + ext
 
     if not args.overwrite and os.path.exists(outname):
         raise FileExistsError(f"Output file {outname} already exists. Use --overwrite to overwrite it.")
@@ -75,14 +175,61 @@ def kill_ripple():
     if args.overwrite and os.path.exists(outname):
         if args.verbose:
             print(f"Output file {outname} already exists, overwriting it.")
-        shutil.rmtree(outname, ignore_errors=True)
+        remove_image(outname)
 
-    shutil.copytree(args.image, outname)
-    ia.open(outname)
-    ia.putchunk(ifftdat[:, :, np.newaxis, np.newaxis])
-    ia.close()
+    if args.verbose:
+        print(f"Writing output to {outname}")
 
+    # The output is created empty with the shape and header of the input,
+    # and the cleaned planes are written to it one at a time
+    inp = open_image(args.image)
+    out = create_like(outname, inp)
+    shape = inp.shape
+    nplanes = int(np.prod(shape[2:]))
+    inflight = args.inflight or 2 * args.workers
+    print(f"Cleaning {nplanes} planes of {shape[0]} x {shape[1]} pixels with {args.workers} workers")
+
+    # First plane before and after, for the diagnostic plots
+    first = {}
+
+    def write_plane(result):
+        index, cleaned, peak_locs = result
+        out.put_plane(index, cleaned)
+        if args.verbose:
+            print(f"Plane {index}: peak locations {peak_locs}")
+            if not any(index):
+                first['after'] = cleaned
+
+    def read_plane(index):
+        dat = inp.get_plane(index)
+        if args.verbose and not any(index):
+            first['before'] = dat
+        return index, dat, args.npeaks, args.notch_width
+
+    try:
+        if args.workers > 1:
+            with Pool(args.workers) as pool:
+                # Planes are submitted in order and written back in the same order,
+                # with at most inflight of them read but not yet written
+                pending = deque()
+                for index in plane_indices(shape):
+                    if len(pending) >= inflight:
+                        write_plane(pending.popleft().get())
+                    pending.append(pool.apply_async(_clean_plane, (read_plane(index),)))
+                while pending:
+                    write_plane(pending.popleft().get())
+        else:
+            # No pool: one plane at a time in this process, without pickling
+            # the planes to a worker and back
+            for index in plane_indices(shape):
+                write_plane(_clean_plane(read_plane(index)))
+    finally:
+        inp.close()
+        out.close()
 
+    if args.verbose:
+        print(f"Plotting the first plane")
+        plot_plane(first['before'], first['after'])
 
 
 if __name__ == '__main__':
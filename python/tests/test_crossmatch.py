@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+import crossmatch
+from catalog_utils import unit_vectors
+
+
+def random_catalog(fname, n, rng):
+    ra = rng.uniform(0, 360, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    pd.DataFrame({'ra': ra, 'dec': dec}).to_csv(fname, index=False)
+    return ra, dec
+
+
+def test_matches_brute_force_with_many_runs(tmp_path):
+    rng = np.random.default_rng(3)
+    ra1, dec1 = random_catalog(tmp_path / 'cat1.csv', 3000, rng)
+    ra2, dec2 = random_catalog(tmp_path / 'cat2.csv', 20000, rng)
+    # A close neighbour in cat2 for every source of cat1
+    ra2[:3000] = (ra1 + rng.normal(0, 1e-3, 3000)) % 360
+    dec2[:3000] = np.clip(dec1 + rng.normal(0, 1e-3, 3000), -90, 90)
+    pd.DataFrame({'ra': ra2, 'dec': dec2}).to_csv(tmp_path / 'cat2.csv', index=False)
+    radius = 60.
+
+    output = tmp_path / 'pairs.csv'
+    # A chunk much smaller than the strips gives several sorted runs per strip
+    crossmatch.crossmatch(str(tmp_path / 'cat1.csv'), str(tmp_path / 'cat2.csv'), str(output), radius,
+                          workers=2, chunk=500, strip_height=5.0, tmpdir=str(tmp_path))
+    pairs = pd.read_csv(output)
+
+    cossep = unit_vectors(ra1, dec1) @ unit_vectors(ra2, dec2).T
+    expected = set(zip(*np.nonzero(cossep >= np.cos(np.radians(radius / 3600)))))
+    assert set(zip(pairs['row1'], pairs['row2'])) == expected
+    assert len(pairs) == len(expected)
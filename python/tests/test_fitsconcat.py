@@ -0,0 +1,216 @@
+import os
+import subprocess
+import sys
+import time
+import warnings
+import weakref
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+import bench_fitsconcat
+import fitsconcat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fitsconcat.py')
+
+
+def make_channel_images(outdir, freqs, shape=(21, 33), nstokes=2, seed=42):
+    return bench_fitsconcat.make_channel_images(outdir, freqs, shape, nstokes=nstokes, seed=seed)
+
+
+def run_fitsconcat(*args):
+    return subprocess.run([sys.executable, SCRIPT, *args], check=True, capture_output=True, text=True)
+
+
+def assert_checksums_valid(cube):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with fits.open(cube, checksum=True, do_not_scale_image_data=True) as hdu:
+            hdu[0].data
+
+
+def test_append_odd_sized_integer_cube(tmp_path):
+    # 33 x 21 int16 planes are not a whole number of 32-bit words, so the
+    # Stokes 1 planes moved by the append change their checksum alignment
+    imlist = make_channel_images(tmp_path, [1e9 + ii * 1e6 for ii in range(3)])
+    extra = make_channel_images(tmp_path, [1.003e9], seed=1)
+    cube = str(tmp_path / 'cube.fits')
+    opts = ['--output', cube, '--bitpix', '16', '--nstokes', '2', '--data-range', '-10', '10']
+
+    run_fitsconcat(*imlist, *opts)
+    assert_checksums_valid(cube)
+
+    result = run_fitsconcat(*imlist, *extra, *opts, '--append')
+    assert 'padding' not in result.stderr
+    assert 'Processing channel 3 (1/1)' in result.stdout
+    assert_checksums_valid(cube)
+    assert fits.getheader(cube)['NAXIS3'] == 4
+    assert fitsconcat.verify_cube(cube) == 0
+
+
+@pytest.mark.parametrize('nbytes', [0, 1, 2, 3, 6, 1385])
+def test_shift_sum(nbytes):
+    data = np.random.default_rng(nbytes).integers(0, 256, 1001, dtype=np.uint8).tobytes()
+    moved = fitsconcat.ones_complement_sum(data, nbytes % 4)
+    assert fitsconcat.shift_sum(fitsconcat.ones_complement_sum(data), nbytes) == moved
+
+
+def test_spectral_major_header_is_valid(tmp_path):
+    imlist = make_channel_images(tmp_path, [1e9 + ii * 1e6 for ii in range(3)])
+    cube = str(tmp_path / 'cube.fits')
+    transposed = str(tmp_path / 'cube_spectral.fits')
+    run_fitsconcat(*imlist, '--output', cube, '--nstokes', '2', '--spectral-major', transposed)
+
+    with fits.open(transposed) as hdu:
+        hdu.verify('exception')
+        assert hdu[0].header['CTYPE1'] == 'FREQ'
+        assert hdu[0].data.shape == (2, 21, 33, 3)
+        np.testing.assert_array_equal(hdu[0].data, fits.getdata(cube).transpose(0, 2, 3, 1))
+
+
+def test_single_channel_keeps_input_width(tmp_path):
+    imlist = make_channel_images(tmp_path, [1.4e9])
+    cube = str(tmp_path / 'cube.fits')
+    run_fitsconcat(*imlist, '--output', cube)
+
+    header = fits.getheader(cube)
+    assert header['NAXIS3'] == 1
+    assert header['CDELT3'] == 1e6
+    assert header['CRVAL3'] == 1.4e9
+
+
+def test_append_below_the_band_is_refused(tmp_path):
+    imlist = make_channel_images(tmp_path, [1.001e9, 1.002e9])
+    cube = str(tmp_path / 'cube.fits')
+    manifest = fitsconcat.prepare_cube(imlist, nstokes=2, outname=cube)
+    fitsconcat.fill_cube_with_images(imlist, outname=cube, manifest=manifest)
+
+    extra = make_channel_images(tmp_path, [1e9], seed=1)
+    with pytest.raises(ValueError, match='must lie above'):
+        fitsconcat.prepare_cube(imlist + extra, nstokes=2, outname=cube, append=True)
+    # the cube is left as it was
+    assert fits.getheader(cube)['NAXIS3'] == 2
+    assert fitsconcat.verify_cube(cube) == 0
+
+
+@pytest.mark.parametrize('writer', ['raw', 'memmap'])
+def test_writers_fill_in_checksums(tmp_path, writer):
+    imlist = make_channel_images(tmp_path, [1e9 + ii * 1e6 for ii in range(3)])
+    cube = str(tmp_path / 'cube.fits')
+    run_fitsconcat(*imlist, '--output', cube, '--nstokes', '2', '--writer', writer)
+
+    assert_checksums_valid(cube)
+    assert fitsconcat.verify_cube(cube) == 0
+
+
+def test_checksums_fit_when_spectral_keys_are_added(tmp_path):
+    # Inputs without CRPIX3/CDELT3 have them added to the cube header after
+    # the planes are written. Over 36 header lengths one puts the END card
+    # at the end of a block, where there is no slack left for them
+    for nfill in range(36):
+        outdir = tmp_path / str(nfill)
+        outdir.mkdir()
+        imlist = []
+        for freq in (1e9, 1.001e9):
+            header = fits.Header()
+            header['CTYPE3'] = 'FREQ'
+            header['CRVAL3'] = freq
+            for ii in range(nfill):
+                header[f'FILL{ii}'] = ii
+            imname = str(outdir / f"chan_{freq / 1e6:.0f}.fits")
+            fits.PrimaryHDU(data=np.ones((1, 1, 4, 5), dtype=np.float32), header=header).writeto(imname)
+            imlist.append(imname)
+
+        cube = str(outdir / 'cube.fits')
+        manifest = fitsconcat.prepare_cube(imlist, nstokes=1, outname=cube)
+        fitsconcat.fill_cube_with_images(imlist, nstokes=1, outname=cube, manifest=manifest)
+        assert_checksums_valid(cube)
+        assert fits.getheader(cube)['CDELT3'] == 1e6
+
+
+def test_scan_cache_survives_odd_values_and_a_corrupt_file(tmp_path):
+    imlist = make_channel_images(tmp_path, [1e9, 1.001e9])
+    for imname in imlist:
+        # A complex value, which JSON cannot hold
+        fits.setval(imname, 'CUNIT1', value=complex(1, 2))
+    cache = str(tmp_path / 'scan.json')
+
+    assert fitsconcat.plan_channels(imlist, cache=cache) == [os.path.abspath(im) for im in imlist]
+    # The entries read back from the cache give the same plan
+    assert fitsconcat.plan_channels(imlist, cache=cache) == [os.path.abspath(im) for im in imlist]
+
+    with open(cache, 'w') as f:
+        f.write('{"truncated": ')
+    assert fitsconcat.plan_channels(imlist, cache=cache) == [os.path.abspath(im) for im in imlist]
+
+
+@pytest.mark.parametrize('bitpix, compression_type', [(16, 'RICE_1'), (8, 'PLIO_1'), (-32, 'RICE_1'),
+                                                      (-32, 'GZIP_2'), (-32, 'HCOMPRESS_1')])
+def test_compress_cube_matches_astropy(tmp_path, bitpix, compression_type):
+    imlist = make_channel_images(tmp_path, [1e9 + ii * 1e6 for ii in range(3)])
+    if bitpix == -32:
+        with fits.open(imlist[1], mode='update') as hdu:
+            hdu[0].data[1, 0, 3, 4] = np.nan
+    cube = str(tmp_path / 'cube.fits')
+    scaling = fitsconcat.integer_scaling(bitpix, -10, 10) if bitpix > 0 else None
+    manifest = fitsconcat.prepare_cube(imlist, nstokes=2, outname=cube, bitpix=bitpix, scaling=scaling)
+    fitsconcat.fill_cube_with_images(imlist, nstokes=2, outname=cube, manifest=manifest)
+
+    fitsconcat.compress_cube(cube, str(tmp_path / 'cube.fz'), compression_type)
+
+    # astropy compressing the whole cube in memory
+    with fits.open(cube, do_not_scale_image_data=True) as hdu:
+        header = hdu[0].header.copy()
+        for key in ('CHECKSUM', 'DATASUM'):
+            header.remove(key)
+        comp = fits.CompImageHDU(data=hdu[0].data, header=header, compression_type=compression_type,
+                                 tile_shape=(1, 1, 21, 33), dither_seed=-1)
+        for key in ('BSCALE', 'BZERO', 'BLANK'):
+            if key in header:
+                comp.header[key] = header[key]
+        fits.HDUList([fits.PrimaryHDU(), comp]).writeto(tmp_path / 'reference.fz')
+
+    # The table rows, and the heap but for the gzip timestamps
+    tables = []
+    for name in ('cube.fz', 'reference.fz'):
+        with fits.open(tmp_path / name, disable_image_compression=True) as hdu:
+            header = hdu[1].header
+            with open(tmp_path / name, 'rb') as f:
+                f.seek(hdu.fileinfo(1)['datLoc'])
+                rows = f.read(header['NAXIS1'] * header['NAXIS2'])
+                heap = f.read(header['PCOUNT'])
+            tables.append(({key: header[key] for key in header if key}, rows, heap))
+    assert tables[0][:2] == tables[1][:2]
+    if not compression_type.startswith('GZIP'):
+        assert tables[0][2] == tables[1][2]
+
+    with fits.open(tmp_path / 'cube.fz') as comp, fits.open(tmp_path / 'reference.fz') as ref:
+        assert np.array_equal(comp[1].data, ref[1].data, equal_nan=True)
+    if bitpix > 0:
+        with fits.open(tmp_path / 'cube.fz') as comp, fits.open(cube) as hdu:
+            assert np.array_equal(comp[1].data, hdu[0].data, equal_nan=True)
+
+
+@pytest.mark.parametrize('window', [1, 2, 4])
+def test_stream_channels_holds_at_most_window_images(monkeypatch, window):
+    live = []
+    most = []
+
+    def read_channel(im, stokes, region=None):
+        data = np.full((len(stokes), 4, 5), im, dtype=np.float32)
+        live.append(weakref.ref(data))
+        most.append(sum(ref() is not None for ref in live))
+        return {}, data
+
+    monkeypatch.setattr(fitsconcat, '_read_channel', read_channel)
+    seen = []
+    for _, data in fitsconcat.stream_channels(range(10), window=window):
+        # give the read-ahead threads time to finish
+        time.sleep(0.01)
+        seen.append(int(data[0, 0, 0]))
+        del data
+
+    assert seen == list(range(10))
+    assert max(most) == window
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import image_io
+
+
+def import_casatools():
+    """
+    casatools, or skip. casaconfig raises its own errors, not ImportError,
+    when the CASA data it needs is not set up.
+    """
+
+    try:
+        import casatools
+    except Exception as exc:
+        pytest.skip(f"casatools is not usable: {exc}")
+    return casatools
+
+
+def test_create_like_fits_keeps_header(tmp_path):
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'], header['BUNIT'] = 'RA---SIN', 'DEC--SIN', 'Jy/beam'
+    fits.PrimaryHDU(data=np.ones((3, 12, 16), dtype=np.float32), header=header).writeto(tmp_path / 'in.fits')
+
+    with image_io.open_image(str(tmp_path / 'in.fits')) as inp:
+        with image_io.create_like(str(tmp_path / 'out.fits'), inp) as out:
+            assert out.shape == [16, 12, 3]
+            assert not out.get_plane((2,)).any()
+            out.put_plane((1,), inp.get_plane((1,)))
+
+    with fits.open(tmp_path / 'out.fits') as hdul:
+        assert hdul[0].header['BUNIT'] == 'Jy/beam'
+        assert hdul[0].header['CTYPE1'] == 'RA---SIN'
+        assert hdul[0].data[1].all() and not hdul[0].data[[0, 2]].any()
+
+
+def test_create_like_casa_keeps_masks_and_miscinfo(tmp_path, monkeypatch):
+    # casatools writes its log to the working directory
+    monkeypatch.chdir(tmp_path)
+    casatools = import_casatools()
+
+    ia = casatools.image()
+    ia.fromshape('in.im', [16, 12, 1, 3], overwrite=True)
+    ia.putchunk(np.random.default_rng(1).random((16, 12, 1, 3)))
+    ia.calcmask('"in.im" > 0.5', name='good')
+    ia.calcmask('"in.im" > 0.1', name='loose', asdefault=False)
+    ia.setmiscinfo({'OBSERVER': 'someone'})
+    ia.setbrightnessunit('Jy/beam')
+    ia.setrestoringbeam(major='10arcsec', minor='5arcsec', pa='20deg')
+    ia.close()
+
+    with image_io.open_image('in.im') as inp:
+        with image_io.create_like('out.im', inp) as out:
+            out.put_plane((0, 1), inp.get_plane((0, 1)))
+            assert sorted(out.ia.maskhandler('get')) == ['good', 'loose']
+            assert out.ia.maskhandler('default') == ['good']
+            assert np.array_equal(out.ia.getchunk(getmask=True), inp.ia.getchunk(getmask=True))
+            assert out.ia.miscinfo()['OBSERVER'] == 'someone'
+            assert out.ia.brightnessunit() == 'Jy/beam'
+            assert out.ia.restoringbeam()['major']['value'] == 10
+            assert np.allclose(out.get_plane((0, 1)), inp.get_plane((0, 1)))
+            assert not out.get_plane((0, 2)).any()
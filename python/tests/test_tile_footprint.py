@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import tile_footprint
+
+
+def unit_vectors(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def worst_gap(ra, dec, lra, ldec):
+    """
+    Largest distance in arcmin from the points ra, dec to the nearest
+    pointing.
+    """
+
+    pointings = unit_vectors(lra, ldec)
+    points = unit_vectors(ra, dec)
+    cosd = np.concatenate([(points[ii:ii + 1000] @ pointings.T).max(axis=1)
+                           for ii in range(0, len(points), 1000)])
+    return np.degrees(np.arccos(np.clip(cosd.min(), -1, 1))) * 60
+
+
+def random_sky(nsample, dec_range, seed=1):
+    rng = np.random.default_rng(seed)
+    z = rng.uniform(*np.sin(np.radians(dec_range)), nsample)
+    return rng.uniform(0, 360, nsample), np.degrees(np.arcsin(z))
+
+
+def points_in_polygon(pra, pdec, nsample=50000):
+    ra0, dec0 = tile_footprint.polygon_centre(pra, pdec)
+    px, py, _ = tile_footprint.gnomonic(pra, pdec, ra0, dec0)
+    ra, dec = random_sky(nsample, (max(pdec.min() - 2, -90), min(pdec.max() + 2, 90)))
+    ra = pra.min() - 2 + ra / 360 * (pra.max() - pra.min() + 4)
+    x, y, cc = tile_footprint.gnomonic(ra, dec, ra0, dec0)
+    inside = (cc > 0) & tile_footprint.in_polygon(x, y, px, py)
+    return ra[inside], dec[inside]
+
+
+@pytest.mark.parametrize('dec0', [-60, 0, 30])
+def test_survey_footprint_is_covered_with_fewer_hex_pointings(dec0):
+    fwhm = 60.
+    pra = np.array([100., 140., 140., 100.])
+    pdec = np.array([dec0 - 20., dec0 - 20., dec0 + 20., dec0 + 20.])
+    ra, dec = points_in_polygon(pra, pdec)
+
+    npointings = {}
+    for lattice in ('hex', 'square'):
+        spacing = tile_footprint.lattice_spacing(fwhm, lattice) / 60
+        lra, ldec = tile_footprint.tile_polygon(pra, pdec, spacing, lattice)
+        assert worst_gap(ra, dec, lra, ldec) <= fwhm / 2
+        npointings[lattice] = len(lra)
+
+    # A hexagonal packing needs 2 / (3 sqrt(3) / 2) = 0.77 times the pointings
+    assert npointings['hex'] / npointings['square'] < 0.8
+
+
+def test_hex_lattice_has_six_neighbours_at_the_spacing():
+    spacing = 1.
+    lra, ldec = tile_footprint.patch_lattice(spacing, 'hex', 30., 10., 5.)
+    vecs = unit_vectors(lra, ldec)
+    centre = np.argmax(vecs @ unit_vectors([30.], [10.])[0])
+    dist = np.sort(np.degrees(np.arccos(np.clip(vecs @ vecs[centre], -1, 1))))
+    np.testing.assert_allclose(dist[1:7], spacing, rtol=1e-3)
+    assert dist[7] > 1.7 * spacing
+
+
+def write_healpix(tmp_path, footprint):
+    hp = pytest.importorskip('healpy')
+    fname = str(tmp_path / 'footprint.fits')
+    hp.write_map(fname, footprint.astype(float), overwrite=True)
+    return fname
+
+
+@pytest.mark.parametrize('disc', [True, False])
+def test_healpix_footprint_is_covered(tmp_path, disc):
+    hp = pytest.importorskip('healpy')
+    nside = 32
+    ra, dec = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)), lonlat=True)
+    # A 30 degree disc is tiled as one patch, the cap above DEC -30 one base
+    # pixel at a time
+    if disc:
+        distance = tile_footprint.angular_distance(ra, dec, 200., 50.) - 30
+    else:
+        distance = -30 - dec
+    footprint = distance <= 0
+    fname = write_healpix(tmp_path, footprint)
+
+    fwhm = 120.
+    spacing = tile_footprint.lattice_spacing(fwhm, 'hex') / 60
+    lra, ldec = tile_footprint.tile_healpix(fname, spacing, 'hex')
+
+    sra, sdec = random_sky(50000, (-90, 90))
+    inside = footprint[hp.ang2pix(nside, sra, sdec, lonlat=True)]
+    assert worst_gap(sra[inside], sdec[inside], lra, ldec) <= fwhm / 2
+
+    # Only pointings reaching the footprint pixels are kept
+    if disc:
+        outside = tile_footprint.angular_distance(lra, ldec, 200., 50.) - 30
+    else:
+        outside = -30 - ldec
+    assert outside.max() <= np.degrees(hp.max_pixrad(nside)) + fwhm / 120
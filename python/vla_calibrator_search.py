@@ -2,23 +2,46 @@
 
 import click
 import datetime
+import os
+import re
+import time
 import numpy as np
-import pandas as pd
 
-from astropy.coordinates import SkyCoord
-import astropy.units as u
+from catalog_utils import CACHE_DIR, parse_positions, read_fields, unit_vectors
 
-from bs4 import BeautifulSoup
-import requests
+VLA_CAL_URL = 'https://science.nrao.edu/facilities/vla/observing/callist'
+CACHE_FILE = os.path.join(CACHE_DIR, 'vla_calibrators.npz')
+# Version of the catalog cache (see catalog_utils), for the parsed columns
+CACHE_VERSION = 1
 
+# Band codes of the manual, in order of wavelength
+BANDS = ['4', 'P', 'L', 'S', 'C', 'X', 'U', 'K', 'A', 'Q']
+BAND_LINE = re.compile(r"^\s*\S+cm\s+([A-Z0-9])\s+(\S)\s+(\S)\s+(\S)\s+(\S)\s*(\S+)?")
+RA_PATTERN = re.compile(r"(\d+)h(\d+)m([\d.]+)s")
+DEC_PATTERN = re.compile(r"([+-]?)(\d+)d(\d+)'([\d.]+)")
+CONFIGS = 'ABCD'
+# Number of targets matched against the catalog at a time
+TARGET_CHUNK = 1024
 
-def vla_cal_to_text(url, persist=False):
+
+def vla_cal_to_text(url, persist=False, html=None):
     """
     Scrape the VLA Calibrator Manual website and store as plain text
+
+    If html is given, the manual is read from that saved copy of the page
+    instead of being downloaded.
     """
 
-    page = requests.get(url)
-    soup = BeautifulSoup(page.text, 'html.parser')
+    from bs4 import BeautifulSoup
+
+    if html is None:
+        import requests
+        text = requests.get(url).text
+    else:
+        with open(html) as fptr:
+            text = fptr.read()
+
+    soup = BeautifulSoup(text, 'html.parser')
     now = datetime.datetime.now()
     now = now.isoformat()
     fname = f'vla_calibrator_manual_{now}.txt'
@@ -42,62 +65,317 @@ def vla_cal_to_text(url, persist=False):
     return allentries
 
 
-def print_source_matches(cal_manual, srcpos, rad):
+def split_entries(cal_manual):
+    """
+    Split the text of the manual into one block of lines per calibrator,
+    each starting at its J2000 position line.
+    """
+
+    entries = []
+    for text in cal_manual:
+        lines = text.splitlines()
+        epoch_idx = [idx for idx, line in enumerate(lines)
+                     if len(line.split()) > 4 and line.split()[1] == 'J2000']
+        for num, line_idx in enumerate(epoch_idx):
+            end = epoch_idx[num+1] if num + 1 < len(epoch_idx) else len(lines)
+            entries.append(lines[line_idx:end])
+
+    return entries
+
+
+def parse_position(ra, dec):
+    """
+    Turn the manual's 00h05m57.17s / 38d20'15.14'' strings into degrees.
+    """
+
+    hh, mm, ss = RA_PATTERN.match(ra).groups()
+    sign, dd, dm, ds = DEC_PATTERN.match(dec).groups()
+    ra_deg = 15 * (int(hh) + int(mm) / 60. + float(ss) / 3600.)
+    dec_deg = int(dd) + int(dm) / 60. + float(ds) / 3600.
+
+    return ra_deg, -dec_deg if sign == '-' else dec_deg
+
+
+def parse_cal_manual(cal_manual):
+    """
+    Parse the manual into a columnar catalog : name, position code, J2000
+    position in degrees, and per band (see BANDS) the flux in Jy and the
+    A/B/C/D quality codes. The text of each entry is kept for printing.
+    """
+
+    entries = split_entries(cal_manual)
+    ncal = len(entries)
+    catalog = {
+        'name': np.empty(ncal, dtype='U16'),
+        'poscode': np.empty(ncal, dtype='U1'),
+        'ra': np.empty(ncal),
+        'dec': np.empty(ncal),
+        'flux': np.full((ncal, len(BANDS)), np.nan, dtype=np.float32),
+        'quality': np.full((ncal, len(BANDS)), '', dtype='U4'),
+        'entry': np.empty(ncal, dtype=object),
+    }
+
+    for ii, lines in enumerate(entries):
+        fields = lines[0].split()
+        catalog['name'][ii] = fields[0]
+        catalog['poscode'][ii] = fields[2]
+        catalog['ra'][ii], catalog['dec'][ii] = parse_position(fields[3], fields[4])
+        catalog['entry'][ii] = "\n".join(lines)
+
+        for line in lines[1:]:
+            match = BAND_LINE.match(line)
+            if match is None or match.group(1) not in BANDS:
+                continue
+            band = BANDS.index(match.group(1))
+            catalog['quality'][ii, band] = ''.join(match.groups()[1:5])
+            try:
+                catalog['flux'][ii, band] = float(match.group(6))
+            except (TypeError, ValueError):
+                pass
+
+    catalog['entry'] = catalog['entry'].astype(str)
+    return catalog
+
+
+def save_catalog(catalog, fname=CACHE_FILE):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmpname = f"{fname}.{os.getpid()}.npz"
+    np.savez(tmpname, version=CACHE_VERSION, fetched=time.time(), **catalog)
+    os.replace(tmpname, fname)
+
+
+def load_catalog(fname=CACHE_FILE, ttl=None):
+    """
+    Load the cached catalog, or return None if it is missing, from an older
+    version, or more than ttl days old.
+    """
+
+    if not os.path.exists(fname):
+        return None
+
+    with np.load(fname) as cache:
+        if int(cache['version']) != CACHE_VERSION:
+            return None
+        if ttl is not None and time.time() - float(cache['fetched']) > ttl * 86400:
+            return None
+        return {key: cache[key] for key in cache.files if key not in ('version', 'fetched')}
+
+
+def get_catalog(refresh=False, offline=False, ttl=30, html=None, persist=False):
+    """
+    Return the calibrator catalog, parsing the manual only when the cache is
+    missing, stale (older than ttl days) or refresh is set. In offline mode
+    the cache is used whatever its age, and the network is never touched.
+
+    A saved copy of the manual page (html) is always parsed. It only replaces
+    the cache with refresh, so that the cache can be seeded for offline use.
+    """
+
+    if html is not None:
+        catalog = parse_cal_manual(vla_cal_to_text(VLA_CAL_URL, persist, html))
+        if refresh:
+            save_catalog(catalog)
+        return catalog
+
+    if not refresh and not persist:
+        catalog = load_catalog(ttl=None if offline else ttl)
+        if catalog is not None:
+            return catalog
+
+    if offline:
+        raise click.ClickException(f"No usable calibrator cache in {CACHE_FILE}, run once without --offline")
+
+    catalog = parse_cal_manual(vla_cal_to_text(VLA_CAL_URL, persist))
+    save_catalog(catalog)
+    return catalog
+
+
+def print_source_matches(catalog, ra0, dec0, rad):
+    """
+    Prints out all matching sources within rad degrees of ra0, dec0 (in
+    degrees).
+
+    catalog is the parsed calibrator manual (see parse_cal_manual).
     """
-    Prints out all matching sources within rad degrees of srcpos.
 
-    cal_manual is assumed to be a list of strings, where each string contains
-    the entire entry from the VLA Calibrator Manual.
+    ra = np.radians(catalog['ra'])
+    dec = np.radians(catalog['dec'])
+    ra0 = np.radians(ra0)
+    dec0 = np.radians(dec0)
+    cossep = np.sin(dec) * np.sin(dec0) + np.cos(dec) * np.cos(dec0) * np.cos(ra - ra0)
+    sep = np.degrees(np.arccos(np.clip(cossep, -1, 1)))
+
+    for idx in np.flatnonzero(sep <= rad):
+        print(catalog['entry'][idx])
+
+
+def read_targets(fname):
+    """
+    Read a target list, one 'name ra dec' per line (whitespace or comma
+    separated, '#' starts a comment), with positions in decimal degrees or
+    sexagesimal.
     """
 
-    for entry in cal_manual:
-        lines = entry.split('\r\n')
-        epoch_idx = [idx for idx, line in enumerate(lines) if 'J2000' in line]
+    rows = read_fields(fname)
+    for fields in rows:
+        if len(fields) != 3:
+            raise click.ClickException(f"Expected 'name ra dec' in {fname}, got : {' '.join(fields)}")
+    ra_deg, dec_deg = parse_positions([fields[1] for fields in rows], [fields[2] for fields in rows])
 
-        if len(epoch_idx) > 1:
-            for num, line_idx in enumerate(epoch_idx):
-                epochline = lines[line_idx]
-                ra = epochline.split()[3]
-                dec = epochline.split()[4]
-                dec = dec.replace("''", "\"")
+    return [fields[0] for fields in rows], ra_deg, dec_deg
 
-                calpos = SkyCoord(ra, dec, equinox='J2000')
-                sep = srcpos.separation(calpos)
 
-                if sep <= rad:
-                    print("\n".join(lines[line_idx:epoch_idx[num+1]]))
+def select_calibrators(catalog, band=None, quality=None, config=None):
+    """
+    Mask of the calibrators usable in band, with a quality code in the
+    allowed codes (e.g. 'PS') in the given array configuration, or in any
+    configuration if config is None.
+    """
+
+    keep = np.ones(len(catalog['name']), dtype=bool)
+    if band is None:
+        return keep
+
+    codes = catalog['quality'][:, BANDS.index(band)]
+    keep &= codes != ''
+    if quality is not None:
+        configs = [CONFIGS.index(config)] if config else range(len(CONFIGS))
+        keep &= np.array([any(len(code) == 4 and code[cc] in quality for cc in configs)
+                          for code in codes])
+    return keep
+
+
+def match_targets(catalog, ra, dec, rad=None, nearest=None, keep=None):
+    """
+    Match all the targets against the calibrators at once, from the dot
+    products of their unit vectors. Returns for each target the indices of
+    the calibrators within rad degrees, or of its nearest calibrators, sorted
+    by separation, and the separations in degrees.
+    """
+
+    cal_index = np.flatnonzero(keep) if keep is not None else np.arange(len(catalog['name']))
+    cal_vec = unit_vectors(catalog['ra'][cal_index], catalog['dec'][cal_index])
+    target_vec = unit_vectors(ra, dec)
+
+    matches = []
+    for start in range(0, len(target_vec), TARGET_CHUNK):
+        cossep = np.clip(target_vec[start:start + TARGET_CHUNK] @ cal_vec.T, -1, 1)
+        sep = np.degrees(np.arccos(cossep))
+        for row in sep:
+            if nearest is not None and nearest < len(row):
+                idx = np.argpartition(row, nearest)[:nearest]
+            else:
+                idx = np.arange(len(row))
+            if rad is not None:
+                idx = idx[row[idx] <= rad]
+            idx = idx[np.argsort(row[idx])]
+            matches.append((cal_index[idx], row[idx]))
+
+    return matches
+
+
+def print_match_table(catalog, name, ra, dec, matches, band=None):
+    """
+    Print the matched calibrators of one target as a table sorted by
+    separation, with the flux and A/B/C/D quality codes in band.
+    """
+
+    print(f"\nTarget {name} : RA={ra:.5f} DEC={dec:.5f}")
+    bandcol = f" {'Flux(Jy)':>9} {'ABCD':>5}" if band else ''
+    print(f"{'Calibrator':<11} {'PC':>2} {'RA':>11} {'DEC':>11} {'Sep(deg)':>9}{bandcol}")
+    for idx, sep in zip(*matches):
+        line = (f"{catalog['name'][idx]:<11} {catalog['poscode'][idx]:>2} "
+                f"{catalog['ra'][idx]:>11.5f} {catalog['dec'][idx]:>11.5f} {sep:>9.3f}")
+        if band:
+            bb = BANDS.index(band)
+            line += f" {catalog['flux'][idx, bb]:>9.2f} {catalog['quality'][idx, bb]:>5}"
+        print(line)
+
 
 ctx = dict(help_option_names=['-h', '--help'])
 @click.command(context_settings=ctx)
-@click.argument('RA', type=str)
-@click.argument('DEC', type=str)
-@click.argument('RAD', type=float)
+@click.argument('RA', type=str, required=False)
+@click.argument('DEC', type=str, required=False)
+@click.argument('RAD', type=float, required=False)
+@click.option('--targets', type=click.Path(exists=True, dir_okay=False),
+              help="File of targets, one 'name ra dec' per line, matched in one pass")
+@click.option('--radius', 'batch_radius', type=float, help='With --targets: search radius in degrees')
+@click.option('--nearest', type=int, help='Only list the N nearest calibrators of each target')
+@click.option('--band', type=click.Choice(BANDS), help='Only list calibrators with a quality code in this band')
+@click.option('--quality', type=str, help="Allowed quality codes in --band, e.g. 'PS'")
+@click.option('--config', type=click.Choice(list(CONFIGS)),
+              help='Array configuration the --quality codes apply to (default: any)')
 @click.option('--persist', is_flag=True, help='Save the calibrator manual to a text file')
-def scrape_vla_cal_list(ra, dec, rad, persist):
+@click.option('--refresh', is_flag=True, help='Download and parse the manual even if the cache is fresh')
+@click.option('--offline', is_flag=True, help='Only use the cached catalog, whatever its age')
+@click.option('--ttl', type=float, default=30, show_default=True,
+              help='Age in days after which the cached catalog is refreshed')
+@click.option('--html', type=click.Path(exists=True, dir_okay=False),
+              help='Parse a saved copy of the calibrator manual page (with --refresh, also cache it for --offline)')
+def scrape_vla_cal_list(ra, dec, rad, persist, refresh, offline, ttl, html,
+                        targets, batch_radius, nearest, band, quality, config):
     """
     Given the input RA and DEC (in sexagesimal or decimal degrees) and the
     search radius RAD (in degrees) searches through the VLA calibrator list and
     prints out all matching sources, including the ancillary information.
 
+    The manual is parsed once into a catalog cached in
+    $XDG_CACHE_HOME/astroscripts/vla_calibrators.npz (~/.cache by default),
+    which is refreshed when it is older than --ttl days.
+
     If the --persist flag is specified, the entire calibrator manual will be
-    written to a text file, which will be named
+    downloaded and written to a text file, which will be named
     vla_calibrator_manual_<current_date_time>.txt
+
+    With --targets, --nearest or --band, a table of calibrators sorted by
+    separation is printed per target instead of the manual entries. RAD is
+    then optional when --nearest is given. With --targets the radius is
+    given with --radius, and RA DEC RAD are not used.
     """
 
-    vla_cal_url = 'https://science.nrao.edu/facilities/vla/observing/callist'
+    if quality is not None and band is None:
+        raise click.UsageError('--quality needs a --band')
+
+    if targets is not None:
+        if ra is not None:
+            raise click.UsageError('RA DEC RAD cannot be combined with --targets, give the radius with --radius')
+        rad = batch_radius
+        names, ras, decs = read_targets(targets)
+    elif batch_radius is not None:
+        raise click.UsageError('--radius is for --targets, give RA DEC RAD')
+    elif ra is None or dec is None:
+        raise click.UsageError('Give RA DEC RAD, or a --targets file')
+
+    if targets is not None or nearest is not None or band is not None:
+        if rad is None and nearest is None:
+            raise click.UsageError('Give a radius (--radius with --targets), --nearest, or both')
+        if targets is None:
+            names, (ras, decs) = ['target'], parse_target(ra, dec)
+
+        catalog = get_catalog(refresh, offline, ttl, html, persist)
+        keep = select_calibrators(catalog, band, quality, config)
+        matches = match_targets(catalog, ras, decs, rad, nearest, keep)
+        for name, tra, tdec, match in zip(names, ras, decs, matches):
+            print_match_table(catalog, name, tra, tdec, match, band)
+        return
+
+    if rad is None:
+        raise click.UsageError('Missing argument RAD')
 
-    try:
-        ra = float(ra)
-        dec = float(dec)
-        srcpos = SkyCoord(ra, dec, unit='degree')
-    except ValueError:
-        srcpos = SkyCoord(ra, dec)
+    ra0, dec0 = parse_target(ra, dec)
 
-    rad = rad * u.degree
+    catalog = get_catalog(refresh, offline, ttl, html, persist)
 
-    cal_manual = vla_cal_to_text(vla_cal_url, persist)
+    print_source_matches(catalog, ra0[0], dec0[0], rad)
+
+
+def parse_target(ra, dec):
+    """
+    RA and DEC of the target in degrees, as one element arrays. astropy is
+    only imported for sexagesimal positions (see parse_positions).
+    """
 
-    print_source_matches(cal_manual, srcpos, rad)
+    return parse_positions([ra], [dec])
 
 
 if __name__ == '__main__':